@@ -5,68 +5,271 @@ Simple Flask app to serve National Grid NYC Metro usage data.
 
 import os
 import asyncio
-from flask import Flask, jsonify
+import tempfile
+from datetime import datetime
+from flask import Flask, g, jsonify, request, Response, send_file, stream_with_context
 import sys
 
 # Import from internal folder
 from internal.nationalgridmetro import NationalGridMetroClient
+from internal.export import EXPORT_FORMATS, check_format, export_history, iter_csv
+from internal.queries import QUERY_PROFILES, parse_fields, select_profile
+from internal.shared_cache import SharedCache, LockTimeout
+from internal.scheduler import PollingScheduler
+from internal.tracing import RequestTrace, SlowRequestProfiler, configure_logging, span
+from internal.health import browser_available
+from internal.forecast import forecast_history
+
+configure_logging()
 
 app = Flask(__name__)
 
-async def get_usage_data():
-    """Get usage data using the National Grid client."""
+# `python3 app.py` runs under the Werkzeug reloader, whose first process only watches files and restarts a
+# serving child; background work (poller, warm browser, health writes) belongs in the child or a gunicorn worker
+SERVING_PROCESS = __name__ != '__main__' or os.environ.get('WERKZEUG_RUN_MAIN') == 'true'
+
+# Opt-in profiling of slow requests (NGNYC_PROFILE_SLOW_MS); reports go next to the token cache
+PROFILER = SlowRequestProfiler.from_env(os.path.join(NationalGridMetroClient().token_cache_dir, 'profiles'))
+
+# Readiness is answered from health.json, kept current by every upstream request and token save
+startup_client = NationalGridMetroClient()
+if SERVING_PROCESS:
+    startup_client.refresh_health()
+HEALTH = startup_client.health
+BROWSER_AVAILABLE = browser_available()
+
+# With a warm browser (NGNYC_DRIVER_POOL), have Chromium running before the next login that needs it
+if SERVING_PROCESS:
+    startup_client.schedule_browser_prestart(startup_client.next_login_at())
+
+@app.before_request
+def start_request_trace():
+    g.request_trace = RequestTrace(f"{request.method} {request.path}", profiler=PROFILER, method=request.method, path=request.path)
+
+@app.after_request
+def record_response_status(response):
+    if 'request_trace' in g:
+        g.request_trace.root.set(status=response.status_code)
+    return response
+
+@app.teardown_request
+def end_request_trace(exc):
+    request_trace = g.pop('request_trace', None)
+    if request_trace is not None:
+        request_trace.end(error=exc)
+
+# Processed results are shared by every worker for this many seconds (0 disables caching)
+RESULT_TTL = int(os.getenv('NGNYC_RESULT_TTL', '300'))
+# How long a worker waits for another worker's login or refresh before giving up
+LOCK_TIMEOUT = int(os.getenv('NGNYC_LOCK_TIMEOUT', '300'))
+
+# "on_demand" fetches upstream per request; "adaptive" serves a background poll that follows the billing cycle
+POLLING_MODE = os.getenv('NGNYC_POLLING', 'on_demand').lower()
+
+def get_credentials():
+    """Return (username, password) from the environment."""
     # Support both USERNAME/PASSWORD and NATIONAL_GRID_USERNAME/NATIONAL_GRID_PASSWORD
     username = os.getenv('USERNAME') or os.getenv('NATIONAL_GRID_USERNAME')
     password = os.getenv('PASSWORD') or os.getenv('NATIONAL_GRID_PASSWORD')
+    return username, password
+
+MISSING_CREDENTIALS = {
+    "success": False,
+    "error": "Missing credentials. Please set USERNAME/PASSWORD or NATIONAL_GRID_USERNAME/NATIONAL_GRID_PASSWORD environment variables."
+}
+
+def result_cache_key(profile=None, fields=None):
+    """Cache key for a /usage variant, or None if the request is invalid."""
+    try:
+        return f"usage|{profile or ''}|{','.join(sorted(parse_fields(fields)))}"
+    except ValueError:
+        return None
+
+async def get_usage_data(profile=None, fields=None):
+    """Get usage data using the National Grid client."""
+    client = NationalGridMetroClient()
+    
+    # In adaptive mode, answer from the scheduler's last poll without going upstream
+    if scheduler is not None:
+        with span("snapshot"):
+            scheduled_result = serve_from_snapshot(client, profile, fields)
+        if scheduled_result:
+            return scheduled_result
     
+    username, password = get_credentials()
     if not username or not password:
+        return dict(MISSING_CREDENTIALS)
+    
+    cache = SharedCache(client.token_cache_dir)
+    cache_key = result_cache_key(profile, fields)
+    
+    try:
+        # Serve from the shared result cache when another worker fetched recently
+        if cache_key:
+            with span("result_cache"):
+                cached_usage = cache.get_result(cache_key, RESULT_TTL)
+            if cached_usage:
+                return cached_usage
+            
+            # Only one worker refreshes a given result; the others wait and reuse it
+            async with cache.lock("refresh", timeout=LOCK_TIMEOUT):
+                cached_usage = cache.get_result(cache_key, RESULT_TTL)
+                if cached_usage:
+                    return cached_usage
+                
+                usage_result = await fetch_usage_data(client, cache, username, password, profile, fields)
+                if usage_result.get("success"):
+                    cache.put_result(cache_key, usage_result)
+                return usage_result
+        
+        return await fetch_usage_data(client, cache, username, password, profile, fields)
+        
+    except LockTimeout as e:
         return {
             "success": False,
-            "error": "Missing credentials. Please set USERNAME/PASSWORD or NATIONAL_GRID_USERNAME/NATIONAL_GRID_PASSWORD environment variables."
+            "error": f"Another worker is still refreshing data: {str(e)}"
         }
+    except Exception as e:
+        return {
+            "success": False,
+            "error": f"Unexpected error: {str(e)}"
+        }
+    finally:
+        client.history.close()
+
+async def fetch_usage_data(client, cache, username, password, profile=None, fields=None):
+    """Fetch fresh usage data, logging in at most once across all workers."""
+    auth_error = await authenticate(client, cache, username, password)
+    if auth_error:
+        return auth_error
     
-    client = NationalGridMetroClient()
-    
-    try:
-        # Step 1: Check for existing valid tokens
+    # Step 3: Get usage and cost data
+    with span("usage"):
+        usage_result = await client.get_usage_and_cost_data(profile, fields)
+    return usage_result
+
+async def authenticate(client, cache, username, password):
+    """Make sure client has a working token and customer URN; returns an error result or None."""
+    # Step 1: Check for existing valid tokens
+    with span("auth.cached_tokens"):
         cached_result = client.load_tokens()
         if cached_result:
             # If we don't have customer URN, we need to get it
             if not client.customer_urn:
                 customer_result = await client.get_customer_data()
+                if customer_result.get("circuit_open"):
+                    # opower.com is failing, not the token; a fresh login would not help
+                    return customer_result
                 if not customer_result["success"]:
                     # If customer data fails, maybe token is invalid, try fresh login
                     cached_result = None
+    
+    # Step 2: If no valid cache, do fresh login while holding the interprocess login lock
+    if not cached_result:
+        rejected_token = (client.tokens or {}).get("access_token")
         
-        # Step 2: If no valid cache, do fresh login
-        if not cached_result:
-            login_result = await client.login_and_get_tokens(username, password)
-            if not login_result["success"]:
-                return login_result
-            
-            # Get customer data after fresh login
-            customer_result = await client.get_customer_data()
-            if not customer_result["success"]:
-                return customer_result
-        
-        # Step 3: Get usage and cost data
-        usage_result = await client.get_usage_and_cost_data()
-        return usage_result
+        with span("auth.login"):
+            async with cache.lock("login", timeout=LOCK_TIMEOUT):
+                # Another worker may have logged in while we waited
+                if client.load_tokens() and client.customer_urn and client.tokens["access_token"] != rejected_token:
+                    cached_result = {"success": True, "source": "cache"}
+                else:
+                    login_result = await client.login_and_get_tokens(username, password)
+                    if not login_result["success"]:
+                        return login_result
+                    
+                    # Get customer data after fresh login
+                    customer_result = await client.get_customer_data()
+                    if not customer_result["success"]:
+                        return customer_result
+    
+    return None
+
+async def poll_bills(profile):
+    """Scheduled upstream poll: fetch the raw bills response and record it to history."""
+    username, password = get_credentials()
+    if not username or not password:
+        return dict(MISSING_CREDENTIALS)
+    
+    client = NationalGridMetroClient()
+    cache = SharedCache(client.token_cache_dir)
+    try:
+        auth_error = await authenticate(client, cache, username, password)
+        if auth_error:
+            return auth_error
         
-    except Exception as e:
-        return {
-            "success": False,
-            "error": f"Unexpected error: {str(e)}"
-        }
+        bills_result = await client.fetch_bills(profile)
+        if bills_result["success"]:
+            client.record_history(bills_result["response"])
+        return bills_result
+    finally:
+        client.history.close()
+
+def serve_from_snapshot(client, profile=None, fields=None):
+    """Build a /usage result from the scheduler snapshot, or None if it cannot answer the request."""
+    snapshot = scheduler.snapshot()
+    if not snapshot:
+        return None
+    
+    try:
+        requested_profile, fields = client.resolve_profile(profile, fields)
+    except ValueError as e:
+        return {"success": False, "error": str(e)}
+    
+    # An explicit profile asks for everything it selects; otherwise only the requested fields matter
+    needed = QUERY_PROFILES[requested_profile] if profile else fields
+    if any(field not in QUERY_PROFILES.get(snapshot.get('profile'), []) for field in needed):
+        return None
+    
+    result = client.summarize_periods(snapshot['data'], fields)
+    if result["success"]:
+        result["query_profile"] = snapshot['profile']
+        result["fetched_at"] = datetime.fromtimestamp(snapshot['fetched_at']).isoformat()
+    return result
+
+def prepare_browser_for_poll(next_poll_at):
+    """Warm the browser before the next scheduled poll if that poll will have to log in again."""
+    client = NationalGridMetroClient()
+    client.schedule_browser_prestart(next_poll_at if next_poll_at >= client.next_login_at() else None)
+
+def create_scheduler():
+    """Build the adaptive polling scheduler from the environment."""
+    client = NationalGridMetroClient()
+    client.ensure_cache_dir()
+    profile = select_profile(parse_fields(os.getenv('NGNYC_POLL_FIELDS')))
+    return PollingScheduler(
+        client.token_cache_dir,
+        poll_bills,
+        lambda: NationalGridMetroClient().history,
+        profile,
+        profiler=PROFILER,
+        # Keep compact records for every field the poll covers; requests pick their fields at serialization
+        decode=lambda poll_profile, response: client.build_periods(response, QUERY_PROFILES[poll_profile]),
+        on_schedule=prepare_browser_for_poll
+    )
+
+scheduler = None
+if POLLING_MODE == 'adaptive' and SERVING_PROCESS:
+    scheduler = create_scheduler()
+    scheduler.start()
 
 @app.route('/usage', methods=['GET'])
 def get_usage():
     """API endpoint to get National Grid usage data."""
+    profile = request.args.get('profile')
+    fields = request.args.get('fields')
+    
+    # Reject unknown fields or profiles before any login or upstream work
+    try:
+        NationalGridMetroClient.resolve_profile(profile, fields)
+    except ValueError as e:
+        return jsonify({"success": False, "error": str(e)}), 400
+    
     try:
         # Run the async function
         loop = asyncio.new_event_loop()
         asyncio.set_event_loop(loop)
-        result = loop.run_until_complete(get_usage_data())
+        result = loop.run_until_complete(get_usage_data(profile, fields))
         loop.close()
         
         return jsonify(result)
@@ -77,6 +280,155 @@ def get_usage():
             "error": f"Server error: {str(e)}"
         }), 500
 
+@app.route('/usage/export', methods=['GET'])
+def export_usage():
+    """Export stored bill or segment history as CSV, Parquet or Arrow."""
+    fmt = request.args.get('format', 'csv').lower()
+    table = request.args.get('table', 'bills')
+    columns = request.args.get('columns')
+    columns = [column.strip() for column in columns.split(',')] if columns else None
+    start = request.args.get('start')
+    end = request.args.get('end')
+    
+    client = NationalGridMetroClient()
+    store = client.history
+    
+    try:
+        check_format(fmt)
+        columns = store.resolve_columns(table, columns)
+    except ValueError as e:
+        store.close()
+        return jsonify({"success": False, "error": str(e)}), 400
+    
+    filename = f"{table}.{EXPORT_FORMATS[fmt]['extension']}"
+    headers = {"Content-Disposition": f"attachment; filename={filename}"}
+    
+    try:
+        if fmt == 'csv':
+            def generate():
+                try:
+                    yield from iter_csv(store, table, columns, start, end)
+                finally:
+                    store.close()
+            
+            return Response(stream_with_context(generate()), mimetype=EXPORT_FORMATS[fmt]['mimetype'], headers=headers)
+        
+        # Columnar formats are written to a temporary file next to the cache and streamed from disk
+        client.ensure_cache_dir()
+        fd, path = tempfile.mkstemp(suffix=f".{EXPORT_FORMATS[fmt]['extension']}", dir=client.token_cache_dir)
+        os.close(fd)
+        try:
+            export_history(store, fmt, path, table, columns, start, end)
+            export_file = open(path, 'rb')
+        finally:
+            store.close()
+            os.remove(path)
+        
+        return send_file(export_file, mimetype=EXPORT_FORMATS[fmt]['mimetype'], as_attachment=True, download_name=filename)
+        
+    except Exception as e:
+        store.close()
+        return jsonify({
+            "success": False,
+            "error": f"Export error: {str(e)}"
+        }), 500
+
+def refresh_history():
+    """Without the background poller, refresh history through the regular (cached) /usage path.
+
+    Returns the failed usage result, or None once history is up to date.
+    """
+    if scheduler is not None:
+        return None
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    usage_result = loop.run_until_complete(get_usage_data())
+    loop.close()
+    if not usage_result.get("success"):
+        return usage_result
+    return None
+
+@app.route('/usage/changes', methods=['GET'])
+def usage_changes():
+    """Bills and segments that are new or changed since the cursor of a previous call."""
+    since = request.args.get('since', '0')
+    if not since.isdigit():
+        return jsonify({"success": False, "error": "since must be a cursor returned by a previous /usage/changes call"}), 400
+    since = int(since)
+    
+    try:
+        refresh_error = refresh_history()
+        if refresh_error:
+            return jsonify(refresh_error)
+        
+        client = NationalGridMetroClient()
+        store = client.history
+        try:
+            cursor = store.current_version()
+            # A cursor from the future means the history was reset; start the client over
+            reset = since > cursor
+            if reset:
+                since = 0
+            return jsonify({
+                "success": True,
+                "since": since,
+                "cursor": cursor,
+                "reset": reset,
+                "bills": store.changes_since("bills", since, cursor),
+                "segments": store.changes_since("segments", since, cursor)
+            })
+        finally:
+            store.close()
+        
+    except Exception as e:
+        return jsonify({
+            "success": False,
+            "error": f"Server error: {str(e)}"
+        }), 500
+
+@app.route('/usage/forecast', methods=['GET'])
+def usage_forecast():
+    """Next-period and 12-month usage and cost projections from a seasonal model of the stored bills."""
+    try:
+        client = NationalGridMetroClient()
+        store = client.history
+        try:
+            # Forecasts come from the bills already stored; only an empty history is fetched synchronously
+            if store.current_version() == 0:
+                refresh_error = refresh_history()
+                if refresh_error:
+                    return jsonify(refresh_error)
+            
+            # The fitted model is reused until new bills change the history version
+            with span("forecast"):
+                forecast = forecast_history(store)
+            return jsonify({"success": True, "data": forecast})
+        except ValueError as e:
+            return jsonify({"success": False, "error": str(e)})
+        finally:
+            store.close()
+        
+    except Exception as e:
+        return jsonify({
+            "success": False,
+            "error": f"Server error: {str(e)}"
+        }), 500
+
+@app.route('/usage/schedule', methods=['GET'])
+def usage_schedule():
+    """Show the adaptive polling state (phase, learned period, next poll)."""
+    if scheduler is None:
+        return jsonify({"polling": POLLING_MODE})
+    
+    state = scheduler.state()
+    snapshot = scheduler.snapshot()
+    return jsonify({
+        "polling": POLLING_MODE,
+        "profile": scheduler.profile,
+        "snapshot_fetched_at": datetime.fromtimestamp(snapshot['fetched_at']).isoformat() if snapshot else None,
+        **state
+    })
+
 @app.route('/health', methods=['GET'])
 def health_check():
     """Simple health check endpoint."""
@@ -85,6 +437,20 @@ def health_check():
         "service": "National Grid NYC Metro Usage API"
     })
 
+@app.route('/ready', methods=['GET'])
+def readiness_check():
+    """Readiness probe: token expiry, data age, last upstream call and circuit state, without any I/O upstream."""
+    ready, checks = HEALTH.readiness(BROWSER_AVAILABLE)
+    if scheduler is not None:
+        state = scheduler.state()
+        checks["scheduler"] = {
+            "phase": state.get("phase"),
+            "last_success_at": state.get("last_success_at"),
+            "next_poll_at": state.get("next_poll_at"),
+            "consecutive_failures": state.get("consecutive_failures")
+        }
+    return jsonify({"ready": ready, "polling": POLLING_MODE, **checks}), 200 if ready else 503
+
 @app.route('/', methods=['GET'])
 def home():
     """Home endpoint with API information."""
@@ -93,7 +459,12 @@ def home():
         "endpoints": {
             "/": "This information page",
             "/health": "Health check",
-            "/usage": "Get usage and cost data"
+            "/ready": "Readiness: token expiry, data age, last upstream status and latency, circuit state (503 when not ready)",
+            "/usage": "Get usage and cost data (?fields=estimated,service_type,total_energy_costs,nem&profile=minimal|nem|full)",
+            "/usage/export": "Export stored history (?format=csv|parquet|arrow&table=bills|segments&columns=&start=&end=)",
+            "/usage/changes": "Bills and segments new or changed since a cursor (?since=<cursor from the previous call>)",
+            "/usage/forecast": "Seasonal usage and cost forecast for the next billing period and the next 12 months",
+            "/usage/schedule": "Adaptive polling state (NGNYC_POLLING=adaptive)"
         },
         "environment_variables_required": [
             "USERNAME or NATIONAL_GRID_USERNAME",
@@ -117,4 +488,4 @@ if __name__ == '__main__':
         print("  python app/app.py")
         sys.exit(1)
     
-    app.run(host='0.0.0.0', port=50583, debug=True) 
\ No newline at end of file
+    app.run(host='0.0.0.0', port=int(os.getenv('NGNYC_PORT', '50583')), debug=True) 
\ No newline at end of file
@@ -0,0 +1,99 @@
+#!/usr/bin/env python3
+"""
+Batch collection for many National Grid Metro NYC accounts.
+Selenium logins are blocking and heavy, so they run in a bounded thread
+pool; customer and GraphQL fetches share one aiohttp session on the
+event loop. Each account's result is written as one JSON line.
+"""
+
+import asyncio
+import aiohttp
+import json
+import sys
+from concurrent.futures import ThreadPoolExecutor
+
+
+def read_credentials(path):
+    """Read a JSON lines credentials file of {"username": ..., "password": ...} objects."""
+    credentials = []
+    with open(path, 'r') as f:
+        for line_number, line in enumerate(f, start=1):
+            line = line.strip()
+            if not line or line.startswith('#'):
+                continue
+            try:
+                entry = json.loads(line)
+            except json.JSONDecodeError as e:
+                raise ValueError(f"{path}:{line_number}: invalid JSON ({e.msg})")
+            if not entry.get('username') or not entry.get('password'):
+                raise ValueError(f"{path}:{line_number}: username and password are required")
+            credentials.append(entry)
+    return credentials
+
+
+def _login_blocking(client, username, password):
+    """Run the Selenium login on a pool thread with its own event loop."""
+    return asyncio.run(client.login_and_get_tokens(username, password))
+
+
+async def fetch_account(client_factory, session, login_pool, username, password):
+    """Fetch usage data for one account, logging in on the pool only when needed."""
+    client = client_factory(cache_key=username, session=session)
+    loop = asyncio.get_running_loop()
+
+    try:
+        # Step 1: Check for existing valid tokens
+        cached_result = client.load_tokens()
+        if cached_result and not client.customer_urn:
+            customer_result = await client.get_customer_data()
+            if not customer_result["success"]:
+                cached_result = None
+
+        # Step 2: If no valid cache, do fresh login on the bounded pool
+        if not cached_result:
+            login_result = await loop.run_in_executor(login_pool, _login_blocking, client, username, password)
+            if not login_result["success"]:
+                return login_result
+
+            customer_result = await client.get_customer_data()
+            if not customer_result["success"]:
+                return customer_result
+
+        # Step 3: Get usage and cost data on the shared session
+        return await client.get_usage_and_cost_data()
+
+    except Exception as e:
+        return {"success": False, "error": f"Unexpected error: {str(e)}"}
+    finally:
+        client.history.close()
+
+
+async def run_batch(client_factory, credentials_path, output_path=None, workers=2, concurrency=8):
+    """Collect every account in credentials_path and write JSON lines to output_path (or stdout)."""
+    credentials = read_credentials(credentials_path)
+    output = open(output_path, 'w') if output_path else sys.stdout
+    write_lock = asyncio.Lock()
+    fetch_slots = asyncio.Semaphore(concurrency)
+    succeeded = 0
+
+    async def collect(entry):
+        nonlocal succeeded
+        async with fetch_slots:
+            result = await fetch_account(client_factory, session, login_pool, entry['username'], entry['password'])
+        async with write_lock:
+            output.write(json.dumps({"username": entry['username'], **result}) + "\n")
+            output.flush()
+            if result.get("success"):
+                succeeded += 1
+
+    try:
+        with ThreadPoolExecutor(max_workers=workers, thread_name_prefix="ngnyc-login") as login_pool:
+            connector = aiohttp.TCPConnector(limit=concurrency)
+            # Accounts share the session, so no cookies may carry over between them; auth is the bearer header
+            async with aiohttp.ClientSession(connector=connector, cookie_jar=aiohttp.DummyCookieJar()) as session:
+                await asyncio.gather(*(collect(entry) for entry in credentials))
+    finally:
+        if output is not sys.stdout:
+            output.close()
+
+    return {"success": succeeded == len(credentials), "accounts": len(credentials), "succeeded": succeeded}
@@ -0,0 +1,230 @@
+#!/usr/bin/env python3
+"""
+Warm Chrome WebDriver manager for fast re-logins.
+Keeps one pre-started browser, clears its cookies and storage between
+logins, health-checks it, and recycles it after a number of uses, on
+memory growth or after sitting idle. Callers that know when the next
+login is due (token expiry, next scheduled poll) use prestart_at() so the
+browser is warm again by then.
+
+Environment variables:
+  NGNYC_DRIVER_POOL          1 to keep a warm browser between logins (default: 0)
+  NGNYC_DRIVER_MAX_USES      logins before the browser is recycled (default: 20)
+  NGNYC_DRIVER_MAX_RSS_MB    recycle when the browser process tree exceeds this RSS (default: 800)
+  NGNYC_DRIVER_IDLE_TIMEOUT  seconds without a login before the browser is shut down, 0 = never (default: 1800)
+"""
+
+import atexit
+import os
+import sys
+import threading
+import time
+from contextlib import contextmanager
+
+try:
+    from .tracing import span
+except ImportError:
+    from tracing import span
+
+# Seconds before an expected login that the browser is started
+PRESTART_LEAD = 120
+
+# Origins whose cookies and storage are cleared between logins
+RESET_ORIGINS = [
+    "https://myaccount.nationalgrid.com",
+    "https://login.nationalgrid.com",
+    "https://ngny-gas.opower.com",
+]
+
+
+def process_tree_pids(root_pid):
+    """Pids of a process and all of its descendants, from the PPid lines in /proc."""
+    children = {}
+    for entry in os.listdir('/proc'):
+        if not entry.isdigit():
+            continue
+        try:
+            with open(f'/proc/{entry}/status', 'r') as f:
+                status = f.read()
+        except OSError:
+            continue
+        fields = dict(line.split(':', 1) for line in status.splitlines() if ':' in line)
+        ppid = int(fields.get('PPid', '0').strip() or 0)
+        children.setdefault(ppid, []).append(int(entry))
+
+    pids = []
+    pending = [root_pid]
+    while pending:
+        pid = pending.pop()
+        pids.append(pid)
+        pending.extend(children.get(pid, []))
+    return pids
+
+
+def process_tree_rss_kb(root_pid):
+    """Sum the resident memory of a process and all of its descendants from /proc."""
+    total = 0
+    for pid in process_tree_pids(root_pid):
+        try:
+            with open(f'/proc/{pid}/status', 'r') as f:
+                status = f.read()
+        except OSError:
+            continue
+        fields = dict(line.split(':', 1) for line in status.splitlines() if ':' in line)
+        # Kernel threads have no VmRSS line
+        total += int(fields.get('VmRSS', '0 kB').split()[0])
+    return total
+
+
+class DriverManager:
+    def __init__(self, create_driver, max_uses=20, max_rss_mb=800, idle_timeout=1800, origins=None):
+        self.create_driver = create_driver
+        self.max_uses = max_uses
+        self.max_rss_mb = max_rss_mb
+        self.idle_timeout = idle_timeout
+        self.origins = origins or RESET_ORIGINS
+        self.driver = None
+        self.uses = 0
+        self._lock = threading.Lock()
+        self._idle_timer = None
+        # Separate lock: prestart_at() is called from inside logins that hold _lock
+        self._prestart_lock = threading.Lock()
+        self._prestart_timer = None
+
+    def prestart(self):
+        """Start the browser now so the first login does not pay for it."""
+        with self._lock:
+            if self.driver is None:
+                try:
+                    self._start()
+                except Exception as e:
+                    # The first login will try again and report the error
+                    print(f"Warning: Could not pre-start browser: {e}", file=sys.stderr)
+                    return
+            self._cancel_idle_shutdown()
+            self._schedule_idle_shutdown()
+
+    def prestart_at(self, when):
+        """Pre-start the browser PRESTART_LEAD seconds before when (epoch seconds); None cancels."""
+        with self._prestart_lock:
+            if self._prestart_timer is not None:
+                self._prestart_timer.cancel()
+                self._prestart_timer = None
+            if when is None:
+                return
+            self._prestart_timer = threading.Timer(max(0, when - PRESTART_LEAD - time.time()), self.prestart)
+            self._prestart_timer.daemon = True
+            self._prestart_timer.start()
+
+    def _start(self):
+        self.driver = self.create_driver()
+        self.uses = 0
+
+    def _stop(self):
+        if self.driver is not None:
+            try:
+                self.driver.quit()
+            except Exception as e:
+                print(f"Warning: Could not stop browser cleanly: {e}", file=sys.stderr)
+            self.driver = None
+
+    def close(self):
+        """Shut the warm browser down."""
+        with self._lock:
+            self._cancel_idle_shutdown()
+            self._stop()
+
+    def is_healthy(self):
+        """True if the browser still answers WebDriver commands."""
+        if self.driver is None:
+            return False
+        try:
+            return bool(self.driver.window_handles)
+        except Exception:
+            return False
+
+    def rss_mb(self):
+        """Resident memory of chromedriver and its browser processes, in MB."""
+        try:
+            return process_tree_rss_kb(self.driver.service.process.pid) / 1024
+        except Exception:
+            return 0
+
+    def needs_recycle(self):
+        """True once the browser has been used max_uses times or grown past max_rss_mb."""
+        if self.max_uses and self.uses >= self.max_uses:
+            return True
+        return bool(self.max_rss_mb) and self.rss_mb() > self.max_rss_mb
+
+    def reset(self):
+        """Clear cookies, caches and site storage so the next login starts signed out."""
+        driver = self.driver
+        with span("browser.reset"):
+            driver.get("about:blank")
+            driver.delete_all_cookies()
+            try:
+                # DevTools commands reach every domain, not just the current page
+                driver.execute_cdp_cmd('Network.clearBrowserCookies', {})
+                driver.execute_cdp_cmd('Network.clearBrowserCache', {})
+                for origin in self.origins:
+                    driver.execute_cdp_cmd('Storage.clearDataForOrigin', {'origin': origin, 'storageTypes': 'all'})
+            except Exception as e:
+                print(f"Warning: Could not clear browser storage via DevTools: {e}", file=sys.stderr)
+
+    @contextmanager
+    def acquire(self):
+        """Yield a clean, healthy driver; only one login uses it at a time."""
+        with self._lock:
+            self._cancel_idle_shutdown()
+            if self.driver is not None and (not self.is_healthy() or self.needs_recycle()):
+                self._stop()
+            if self.driver is None:
+                self._start()
+            else:
+                self.reset()
+
+            failed = False
+            try:
+                yield self.driver
+            except Exception:
+                failed = True
+                raise
+            finally:
+                self.uses += 1
+                # A browser that raised mid-login may be in any state, so start fresh next time
+                if failed or not self.is_healthy() or self.needs_recycle():
+                    self._stop()
+                self._schedule_idle_shutdown()
+
+    def _schedule_idle_shutdown(self):
+        if self.idle_timeout and self.driver is not None:
+            self._idle_timer = threading.Timer(self.idle_timeout, self.close)
+            self._idle_timer.daemon = True
+            self._idle_timer.start()
+
+    def _cancel_idle_shutdown(self):
+        if self._idle_timer is not None:
+            self._idle_timer.cancel()
+            self._idle_timer = None
+
+
+_manager = None
+_manager_lock = threading.Lock()
+
+
+def driver_manager_from_env(create_driver):
+    """Return the process-wide DriverManager if NGNYC_DRIVER_POOL is enabled, else None."""
+    global _manager
+    if os.getenv('NGNYC_DRIVER_POOL', '0').lower() not in ('1', 'true', 'yes'):
+        return None
+    with _manager_lock:
+        if _manager is None:
+            _manager = DriverManager(
+                create_driver,
+                max_uses=int(os.getenv('NGNYC_DRIVER_MAX_USES', '20')),
+                max_rss_mb=int(os.getenv('NGNYC_DRIVER_MAX_RSS_MB', '800')),
+                idle_timeout=int(os.getenv('NGNYC_DRIVER_IDLE_TIMEOUT', '1800'))
+            )
+            # Never leave an orphaned browser behind when the worker exits
+            atexit.register(_manager.close)
+        return _manager
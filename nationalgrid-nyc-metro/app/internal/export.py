@@ -0,0 +1,123 @@
+#!/usr/bin/env python3
+"""
+Columnar export of the stored bill and segment history.
+CSV uses the standard library; Parquet and Arrow need the optional
+pyarrow package. Rows are streamed from the history store in batches
+so exports never hold the full history in memory.
+"""
+
+import csv
+import io
+
+try:
+    from .history import NUMERIC_COLUMNS, BOOLEAN_COLUMNS, INTEGER_COLUMNS
+except ImportError:
+    from history import NUMERIC_COLUMNS, BOOLEAN_COLUMNS, INTEGER_COLUMNS
+
+try:
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+except ImportError:
+    pa = None
+    pq = None
+
+EXPORT_FORMATS = {
+    "csv": {"mimetype": "text/csv", "extension": "csv"},
+    "parquet": {"mimetype": "application/vnd.apache.parquet", "extension": "parquet"},
+    "arrow": {"mimetype": "application/vnd.apache.arrow.file", "extension": "arrow"},
+}
+
+BATCH_SIZE = 1000
+
+
+def check_format(fmt):
+    """Raise ValueError if the format is unknown or its dependency is missing."""
+    if fmt not in EXPORT_FORMATS:
+        raise ValueError(f"Unknown export format '{fmt}'. Expected one of: {', '.join(EXPORT_FORMATS)}")
+    if fmt in ("parquet", "arrow") and pa is None:
+        raise ValueError(f"The {fmt} format requires pyarrow (pip install pyarrow)")
+
+
+def _arrow_schema(columns):
+    fields = []
+    for column in columns:
+        if column in NUMERIC_COLUMNS:
+            fields.append(pa.field(column, pa.float64()))
+        elif column in BOOLEAN_COLUMNS:
+            fields.append(pa.field(column, pa.bool_()))
+        elif column in INTEGER_COLUMNS:
+            fields.append(pa.field(column, pa.int64()))
+        else:
+            fields.append(pa.field(column, pa.string()))
+    return pa.schema(fields)
+
+
+def _iter_batches(rows, columns, schema):
+    """Group row tuples into Arrow record batches of BATCH_SIZE rows."""
+    batch = []
+    for row in rows:
+        batch.append(row)
+        if len(batch) >= BATCH_SIZE:
+            yield _to_record_batch(batch, columns, schema)
+            batch = []
+    if batch:
+        yield _to_record_batch(batch, columns, schema)
+
+
+def _to_record_batch(batch, columns, schema):
+    arrays = []
+    for index, column in enumerate(columns):
+        values = [row[index] for row in batch]
+        if column in BOOLEAN_COLUMNS:
+            values = [None if value is None else bool(value) for value in values]
+        arrays.append(pa.array(values, type=schema.field(column).type))
+    return pa.RecordBatch.from_arrays(arrays, schema=schema)
+
+
+def iter_csv(store, table, columns=None, start=None, end=None):
+    """Yield CSV text chunks (header first) for streaming HTTP responses."""
+    columns = store.resolve_columns(table, columns)
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    writer.writerow(columns)
+    for count, row in enumerate(store.iter_rows(table, columns, start, end), start=1):
+        writer.writerow(row)
+        if count % BATCH_SIZE == 0:
+            yield buffer.getvalue()
+            buffer.seek(0)
+            buffer.truncate()
+    yield buffer.getvalue()
+
+
+def export_history(store, fmt, output_path, table="bills", columns=None, start=None, end=None):
+    """Write stored history to output_path and return the number of rows written."""
+    check_format(fmt)
+    columns = store.resolve_columns(table, columns)
+    rows = store.iter_rows(table, columns, start, end)
+    written = 0
+
+    if fmt == "csv":
+        with open(output_path, 'w', newline='') as f:
+            writer = csv.writer(f)
+            writer.writerow(columns)
+            for row in rows:
+                writer.writerow(row)
+                written += 1
+        return written
+
+    schema = _arrow_schema(columns)
+    if fmt == "parquet":
+        writer = pq.ParquetWriter(output_path, schema)
+        try:
+            for batch in _iter_batches(rows, columns, schema):
+                writer.write_batch(batch)
+                written += batch.num_rows
+        finally:
+            writer.close()
+    else:
+        with pa.OSFile(output_path, 'wb') as sink:
+            with pa.ipc.new_file(sink, schema) as writer:
+                for batch in _iter_batches(rows, columns, schema):
+                    writer.write_batch(batch)
+                    written += batch.num_rows
+    return written
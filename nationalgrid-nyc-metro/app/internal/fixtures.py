@@ -0,0 +1,161 @@
+#!/usr/bin/env python3
+"""
+Record/replay transports for the opower.com customer and GraphQL calls.
+Recording captures each exchange with bearer tokens scrubbed into a JSON
+fixture file; replaying serves those responses offline with optional
+injected latency, so parsing and processing can be profiled on
+real-shaped data without network access.
+
+Environment variables:
+  NGNYC_RECORD              fixture file to record live exchanges into
+  NGNYC_REPLAY              fixture file to replay instead of calling opower.com
+  NGNYC_REPLAY_LATENCY_MS   latency added to every replayed response (default: 0)
+  NGNYC_REPLAY_JITTER_MS    random extra latency up to this many ms (default: 0)
+"""
+
+import asyncio
+import json
+import os
+import random
+import re
+import tempfile
+from datetime import datetime
+from urllib.parse import urlsplit
+
+FIXTURE_VERSION = 1
+
+SCRUBBED = "<scrubbed>"
+
+# JWTs (header.payload.signature, base64url) wherever they appear in a body
+JWT_PATTERN = re.compile(r'eyJ[A-Za-z0-9_-]+\.[A-Za-z0-9_-]+\.[A-Za-z0-9_-]*')
+
+# Parsed replay fixtures keyed by (path, mtime), shared by every client in the process
+_replay_cache = {}
+
+
+def exchange_key(method, url, payload=None):
+    """Match key for an exchange: method, URL path and GraphQL operation name."""
+    operation = payload.get('operationName') if isinstance(payload, dict) else None
+    return f"{method.upper()} {urlsplit(url).path} {operation or ''}".strip()
+
+
+def scrub(text, headers=None):
+    """Remove bearer tokens from a response body."""
+    if not text:
+        return text
+    if headers:
+        authorization = headers.get('Authorization', '')
+        if authorization.startswith('Bearer '):
+            text = text.replace(authorization[len('Bearer '):], SCRUBBED)
+    return JWT_PATTERN.sub(SCRUBBED, text)
+
+
+def load_fixture(path):
+    """Load a fixture file and return its list of exchanges."""
+    with open(path, 'r') as f:
+        fixture = json.load(f)
+    if fixture.get('version') != FIXTURE_VERSION:
+        raise ValueError(f"Unsupported fixture version in {path}: {fixture.get('version')}")
+    return fixture.get('exchanges', [])
+
+
+def save_fixture(path, exchanges):
+    """Atomically write exchanges to a fixture file."""
+    directory = os.path.dirname(os.path.abspath(path))
+    os.makedirs(directory, exist_ok=True)
+    fd, tmp_path = tempfile.mkstemp(dir=directory, suffix='.tmp')
+    try:
+        with os.fdopen(fd, 'w') as f:
+            json.dump({"version": FIXTURE_VERSION, "exchanges": exchanges}, f, indent=2)
+        os.replace(tmp_path, path)
+    except Exception:
+        os.remove(tmp_path)
+        raise
+
+
+class RecordingTransport:
+    """Send requests live and append every exchange to a fixture file."""
+
+    offline = False
+
+    def __init__(self, path):
+        self.path = path
+        self.exchanges = load_fixture(path) if os.path.exists(path) else []
+
+    async def request(self, send, method, url, headers, payload=None):
+        status, body = await send(method, url, headers, payload)
+
+        # Store the body as JSON when possible so fixtures stay readable and editable
+        body = scrub(body, headers)
+        try:
+            recorded_body = json.loads(body)
+        except (TypeError, ValueError):
+            recorded_body = body
+
+        self.exchanges.append({
+            "key": exchange_key(method, url, payload),
+            "request": {"method": method.upper(), "path": urlsplit(url).path, "payload": payload},
+            "status": status,
+            "body": recorded_body,
+            "recorded_at": datetime.now().isoformat()
+        })
+        save_fixture(self.path, self.exchanges)
+        return status, body
+
+
+class ReplayTransport:
+    """Serve recorded exchanges offline, cycling through repeats of the same key."""
+
+    offline = True
+    placeholder_token = "replay-token"
+
+    def __init__(self, path, latency_ms=0, jitter_ms=0):
+        self.path = path
+        self.latency_ms = latency_ms
+        self.jitter_ms = jitter_ms
+        self.responses = self._load_responses(path)
+        self._positions = {}
+
+    @staticmethod
+    def _load_responses(path):
+        cache_key = (os.path.abspath(path), os.path.getmtime(path))
+        responses = _replay_cache.get(cache_key)
+        if responses is None:
+            responses = {}
+            for exchange in load_fixture(path):
+                body = exchange.get('body')
+                if not isinstance(body, str):
+                    body = json.dumps(body)
+                responses.setdefault(exchange['key'], []).append((exchange.get('status', 200), body))
+            _replay_cache.clear()
+            _replay_cache[cache_key] = responses
+        return responses
+
+    async def request(self, send, method, url, headers, payload=None):
+        delay = self.latency_ms + (random.uniform(0, self.jitter_ms) if self.jitter_ms else 0)
+        if delay:
+            await asyncio.sleep(delay / 1000)
+
+        key = exchange_key(method, url, payload)
+        responses = self.responses.get(key)
+        if not responses:
+            return 404, json.dumps({"error": f"No recorded exchange for {key}"})
+
+        position = self._positions.get(key, 0)
+        self._positions[key] = position + 1
+        return responses[position % len(responses)]
+
+
+def transport_from_env():
+    """Build a transport from NGNYC_RECORD / NGNYC_REPLAY, or None for live requests."""
+    replay_path = os.getenv('NGNYC_REPLAY')
+    if replay_path:
+        return ReplayTransport(
+            replay_path,
+            latency_ms=float(os.getenv('NGNYC_REPLAY_LATENCY_MS', '0')),
+            jitter_ms=float(os.getenv('NGNYC_REPLAY_JITTER_MS', '0'))
+        )
+    record_path = os.getenv('NGNYC_RECORD')
+    if record_path:
+        return RecordingTransport(record_path)
+    return None
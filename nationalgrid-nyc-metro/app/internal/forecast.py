@@ -0,0 +1,178 @@
+#!/usr/bin/env python3
+"""
+Seasonal usage and cost forecasts from the stored bill history.
+Daily gas use is modelled as a mean plus annual harmonics (cos/sin of the
+time of year), the smooth heating-season curve a heating-degree model would
+give without needing weather data. Each bill is fitted on the average of
+the curve over its own start/end interval, so bills of any length can be
+mixed. Cost is fitted as a daily customer charge plus a price per unit on
+the most recent bills. Fits use NumPy least squares and are cached per
+history store until its version changes, i.e. until new or changed bills
+are recorded. Without numpy the forecast reports an error instead of the
+API failing to start.
+"""
+
+import math
+import threading
+from datetime import datetime, timedelta, timezone
+
+try:
+    from .scheduler import CADENCE_SAMPLE
+except ImportError:
+    from scheduler import CADENCE_SAMPLE
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+SECONDS_PER_DAY = 86400
+DAYS_PER_YEAR = 365.2425
+
+# Annual harmonics used once there are enough bills to support them (each adds two coefficients)
+MAX_HARMONICS = 2
+BILLS_PER_HARMONIC = 5
+
+# Recent bills used for the cost model, so rate changes show up quickly
+COST_SAMPLE = 12
+
+BILL_FIELDS = ["start_date", "end_date", "usage_amount", "usage_unit", "cost_amount", "cost_unit"]
+
+
+def _seasonal_basis(start_years, end_years, harmonics):
+    """Design matrix: average of 1, cos(2πkt), sin(2πkt) over each [start, end] interval (t in years)."""
+    length = end_years - start_years
+    columns = [np.ones_like(start_years)]
+    for k in range(1, harmonics + 1):
+        omega = 2 * math.pi * k
+        columns.append((np.sin(omega * end_years) - np.sin(omega * start_years)) / (omega * length))
+        columns.append((np.cos(omega * start_years) - np.cos(omega * end_years)) / (omega * length))
+    return np.column_stack(columns)
+
+
+def _load_bills(store):
+    """Completed bills as arrays, oldest first; bills without usage or with empty intervals are skipped."""
+    starts, ends, usage, cost = [], [], [], []
+    units = (None, None)
+    offset = timedelta(0)
+    for start_date, end_date, usage_amount, usage_unit, cost_amount, cost_unit in store.iter_rows("bills", BILL_FIELDS):
+        if usage_amount is None or not start_date or not end_date:
+            continue
+        try:
+            start_dt = datetime.fromisoformat(start_date)
+            end_dt = datetime.fromisoformat(end_date)
+        except ValueError:
+            continue
+        if end_dt <= start_dt:
+            continue
+        starts.append(start_dt.timestamp())
+        ends.append(end_dt.timestamp())
+        usage.append(usage_amount)
+        cost.append(cost_amount if cost_amount is not None else math.nan)
+        units = (usage_unit, cost_unit)
+        offset = end_dt.utcoffset() or offset
+    return np.array(starts), np.array(ends), np.array(usage, dtype=float), np.array(cost, dtype=float), units, offset
+
+
+def _fit_cost(days, usage, cost):
+    """Return (daily charge, price per unit) from the most recent bills with a cost."""
+    known = ~np.isnan(cost)
+    days, usage, cost = days[known][-COST_SAMPLE:], usage[known][-COST_SAMPLE:], cost[known][-COST_SAMPLE:]
+    if len(cost) == 0:
+        return None
+    if len(cost) >= 3:
+        (daily_charge, unit_price), *_ = np.linalg.lstsq(np.column_stack([days, usage]), cost, rcond=None)
+        if daily_charge >= 0 and unit_price >= 0:
+            return float(daily_charge), float(unit_price)
+    # Too few bills, or usage too flat to separate the fixed charge: fall back to the average price
+    total_usage = usage.sum()
+    if total_usage > 0:
+        return 0.0, float(cost.sum() / total_usage)
+    return float(cost.sum() / days.sum()), 0.0
+
+
+def fit_forecast(store):
+    """Fit the history and project the next billing period and the next 12 months.
+
+    Raises ValueError if numpy is missing or there are no usable bills.
+    """
+    if np is None:
+        raise ValueError("Forecasting requires numpy (pip install numpy)")
+    version = store.current_version()
+    starts, ends, usage, cost, (usage_unit, cost_unit), offset = _load_bills(store)
+    if len(usage) == 0:
+        raise ValueError("No stored bills to forecast from yet")
+
+    year = DAYS_PER_YEAR * SECONDS_PER_DAY
+    days = (ends - starts) / SECONDS_PER_DAY
+    harmonics = min(MAX_HARMONICS, (len(usage) - 1) // BILLS_PER_HARMONIC)
+
+    # usage = days * mean daily rate over the bill, which is linear in the coefficients
+    design = _seasonal_basis(starts / year, ends / year, harmonics) * days[:, None]
+    coefficients, *_ = np.linalg.lstsq(design, usage, rcond=None)
+    fitted = design @ coefficients
+    cost_model = _fit_cost(days, usage, cost)
+
+    # Future periods follow the learned billing cadence from the end of the latest bill
+    period_days = float(np.median(days[-CADENCE_SAMPLE:]))
+    count = max(1, round(DAYS_PER_YEAR / period_days))
+    future_starts = ends.max() + np.arange(count) * period_days * SECONDS_PER_DAY
+    future_ends = future_starts + period_days * SECONDS_PER_DAY
+    future_usage = np.maximum(_seasonal_basis(future_starts / year, future_ends / year, harmonics) @ coefficients, 0) * period_days
+    if cost_model is not None:
+        future_cost = cost_model[0] * period_days + cost_model[1] * future_usage
+
+    local = timezone(offset)
+    periods = []
+    for i in range(count):
+        periods.append({
+            "start_date": datetime.fromtimestamp(future_starts[i], local).date().isoformat(),
+            "end_date": datetime.fromtimestamp(future_ends[i], local).date().isoformat(),
+            "days": round(period_days, 1),
+            "usage_amount": round(float(future_usage[i]), 2),
+            "usage_unit": usage_unit,
+            "cost_amount": round(float(future_cost[i]), 2) if cost_model is not None else None,
+            "cost_unit": cost_unit
+        })
+
+    return {
+        "next_period": periods[0],
+        "next_12_months": {
+            "start_date": periods[0]["start_date"],
+            "end_date": periods[-1]["end_date"],
+            "usage_amount": round(float(future_usage.sum()), 2),
+            "usage_unit": usage_unit,
+            "cost_amount": round(float(future_cost.sum()), 2) if cost_model is not None else None,
+            "cost_unit": cost_unit,
+            "periods": periods
+        },
+        "model": {
+            "type": "seasonal_harmonic",
+            "harmonics": harmonics,
+            "bills_used": len(usage),
+            "period_days": round(period_days, 1),
+            "usage_rmse": round(float(np.sqrt(np.mean((usage - fitted) ** 2))), 2),
+            "daily_charge": round(cost_model[0], 4) if cost_model is not None else None,
+            "unit_price": round(cost_model[1], 4) if cost_model is not None else None,
+            "history_version": version,
+            "fitted_at": datetime.now().isoformat()
+        }
+    }
+
+
+_forecasts = {}
+_forecasts_lock = threading.Lock()
+
+
+def forecast_history(store):
+    """Cached fit_forecast(); refits only when the store's version has moved since the last fit."""
+    version = store.current_version()
+    cached = _forecasts.get(store.path)
+    if cached is not None and cached[0] == version:
+        return cached[1]
+    with _forecasts_lock:
+        cached = _forecasts.get(store.path)
+        if cached is None or cached[0] != version:
+            cached = (version, fit_forecast(store))
+            _forecasts[store.path] = cached
+        return cached[1]
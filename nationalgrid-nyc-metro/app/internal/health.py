@@ -0,0 +1,235 @@
+#!/usr/bin/env python3
+"""
+Upstream health bookkeeping for readiness probes.
+Every opower.com request, token save and successful bill fetch updates a
+small health.json in the cache directory, so a readiness check only reads
+that file (re-parsed when it changes) and never calls upstream itself.
+A circuit breaker stops calling opower.com after repeated failures and
+lets a single trial request through once the cool-down has passed.
+
+Environment variables:
+  NGNYC_CIRCUIT_FAILURES   consecutive upstream failures that open the circuit (default: 5)
+  NGNYC_CIRCUIT_RESET      seconds the circuit stays open before a trial request (default: 60)
+"""
+
+import os
+import shutil
+import sys
+import threading
+import time
+
+try:
+    from .shared_cache import atomic_write_json, read_json
+    from .httplogin import decode_jwt_payload
+except ImportError:
+    from shared_cache import atomic_write_json, read_json
+    from httplogin import decode_jwt_payload
+
+HEALTH_FILE = "health.json"
+
+CLOSED = "closed"
+OPEN = "open"
+HALF_OPEN = "half_open"
+
+# Same safety margin is_token_expired() applies before reusing a token
+TOKEN_EXPIRY_BUFFER = 300
+
+
+class CircuitOpenError(Exception):
+    """Raised instead of calling upstream while the circuit is open."""
+
+
+def token_expiry(tokens):
+    """Epoch seconds at which an access token expires (JWT exp, else expires_on), or None."""
+    if not tokens or not tokens.get('access_token'):
+        return None
+    claims = decode_jwt_payload(tokens['access_token']) or {}
+    expires_at = claims.get('exp') or tokens.get('expires_on')
+    return int(expires_at) if expires_at else None
+
+
+def browser_available():
+    """True if chromedriver can be found for a Selenium login."""
+    path = os.getenv('CHROMEDRIVER_PATH')
+    if path:
+        return os.access(path, os.X_OK)
+    return shutil.which('chromedriver') is not None
+
+
+class CircuitBreaker:
+    def __init__(self, failure_threshold=5, reset_timeout=60):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.state = CLOSED
+        self.failures = 0
+        self.opened_at = None
+        self._lock = threading.Lock()
+
+    def allow(self):
+        """True if a request may go upstream now; moves an expired open circuit to half-open."""
+        with self._lock:
+            if self.state == CLOSED:
+                return True
+            # A trial that never reported back (e.g. its worker died) is retried after another cool-down
+            if time.time() - self.opened_at >= self.reset_timeout:
+                # Let exactly one trial request through; opened_at now marks when it started
+                self.state = HALF_OPEN
+                self.opened_at = time.time()
+                return True
+            return False
+
+    def record_success(self):
+        with self._lock:
+            self.state = CLOSED
+            self.failures = 0
+            self.opened_at = None
+
+    def record_failure(self):
+        with self._lock:
+            self.failures += 1
+            if self.state == HALF_OPEN or self.failures >= self.failure_threshold:
+                self.state = OPEN
+                self.opened_at = time.time()
+
+    def retry_in(self):
+        if self.state == CLOSED:
+            return 0
+        return max(0, self.opened_at + self.reset_timeout - time.time())
+
+    def to_dict(self):
+        return {"state": self.state, "consecutive_failures": self.failures, "opened_at": self.opened_at}
+
+    def restore(self, data):
+        """Pick up the persisted state, so a restarted worker does not hammer a failing upstream."""
+        self.state = data.get('state', CLOSED)
+        self.failures = data.get('consecutive_failures', 0)
+        self.opened_at = data.get('opened_at')
+        if self.state == HALF_OPEN:
+            # The trial request died with its process; treat it as failed
+            self.state = OPEN
+            self.opened_at = self.opened_at or time.time()
+
+
+class UpstreamHealth:
+    """Health state of one cache directory, shared by every client in the process."""
+
+    def __init__(self, cache_dir, breaker=None):
+        self.path = os.path.join(cache_dir, HEALTH_FILE)
+        self.breaker = breaker or CircuitBreaker()
+        self._lock = threading.Lock()
+        self._state = read_json(self.path) or {}
+        self.breaker.restore(self._state.get('circuit') or {})
+        self._shared = None
+        self._shared_mtime = None
+
+    def _save(self, **changes):
+        with self._lock:
+            # Merge into the latest file so other workers' updates are kept
+            self._state = {**(read_json(self.path) or {}), **changes, "circuit": self.breaker.to_dict()}
+            try:
+                os.makedirs(os.path.dirname(self.path), mode=0o700, exist_ok=True)
+                atomic_write_json(self.path, self._state)
+            except OSError as e:
+                print(f"Warning: Could not save health state: {e}", file=sys.stderr)
+
+    def check_circuit(self):
+        """Raise CircuitOpenError unless a request may go upstream."""
+        if not self.breaker.allow():
+            raise CircuitOpenError(
+                f"opower.com circuit is open after {self.breaker.failures} consecutive failures; "
+                f"retrying in {self.breaker.retry_in():.0f}s"
+            )
+
+    def record_request(self, status=None, latency_ms=None, error=None):
+        """Record an upstream response (or a network error); 5xx and errors count against the circuit."""
+        if error is not None or status is None or status >= 500:
+            self.breaker.record_failure()
+        else:
+            self.breaker.record_success()
+        self._save(last_request={
+            "at": time.time(),
+            "status": status,
+            "latency_ms": round(latency_ms, 1) if latency_ms is not None else None,
+            "error": error
+        })
+
+    def record_tokens(self, tokens, login_configured):
+        self._save(token={"expires_at": token_expiry(tokens), "saved_at": time.time()}, login_configured=login_configured)
+
+    def record_data(self):
+        """Note a successful bill fetch; readiness reports the data age from it."""
+        self._save(last_data_at=time.time())
+
+    def shared_state(self):
+        """Latest state written by any worker; re-read only when the file changes."""
+        try:
+            mtime = os.path.getmtime(self.path)
+        except OSError:
+            return {}
+        if mtime != self._shared_mtime:
+            self._shared = read_json(self.path) or {}
+            self._shared_mtime = mtime
+        return self._shared
+
+    def readiness(self, browser_available, now=None):
+        """Build the /ready report from the shared state; returns (ready, checks)."""
+        now = time.time() if now is None else now
+        state = self.shared_state()
+        
+        expires_at = (state.get('token') or {}).get('expires_at')
+        if expires_at is None:
+            token = {"status": "missing"}
+        else:
+            expires_in = int(expires_at - now)
+            token = {
+                "status": "valid" if expires_in > TOKEN_EXPIRY_BUFFER else "expired",
+                "expires_in": expires_in,
+                "expires_at": expires_at
+            }
+        
+        last_data_at = state.get('last_data_at')
+        data = {
+            "age_seconds": int(now - last_data_at) if last_data_at else None,
+            "last_success_at": last_data_at
+        }
+        
+        last_request = state.get('last_request') or {}
+        upstream = {
+            "last_status": last_request.get('status'),
+            "last_latency_ms": last_request.get('latency_ms'),
+            "last_request_at": last_request.get('at'),
+            "last_error": last_request.get('error')
+        }
+        
+        circuit = dict(state.get('circuit') or {"state": CLOSED, "consecutive_failures": 0, "opened_at": None})
+        if circuit['state'] == OPEN:
+            retry_in = circuit['opened_at'] + self.breaker.reset_timeout - now
+            if retry_in <= 0:
+                # The next request will be let through as a trial
+                circuit['state'] = HALF_OPEN
+            else:
+                circuit['retry_in'] = round(retry_in)
+        
+        login = {
+            "browser_available": browser_available,
+            "http_login_configured": bool(state.get('login_configured'))
+        }
+        
+        can_authenticate = token['status'] == "valid" or login['browser_available'] or login['http_login_configured']
+        ready = circuit['state'] != OPEN and can_authenticate
+        return ready, {"token": token, "data": data, "upstream": upstream, "circuit": circuit, "login": login}
+
+
+_health = {}
+_health_lock = threading.Lock()
+
+
+def upstream_health(cache_dir):
+    """Return the process-wide UpstreamHealth for a cache directory."""
+    with _health_lock:
+        if cache_dir not in _health:
+            _health[cache_dir] = UpstreamHealth(cache_dir, CircuitBreaker(
+                failure_threshold=int(os.getenv('NGNYC_CIRCUIT_FAILURES', '5')),
+                reset_timeout=int(os.getenv('NGNYC_CIRCUIT_RESET', '60'))
+            ))
+        return _health[cache_dir]
@@ -0,0 +1,214 @@
+#!/usr/bin/env python3
+"""
+Persistent bill and segment history for National Grid Metro NYC accounts.
+Every successful GraphQL fetch is upserted here so exports and analytics
+can read history without going back to opower.com.
+
+Each write that changes anything bumps a store-wide version counter, and
+rows remember the version that last changed them, so clients can ask for
+only what changed since a version they already hold (changes_since).
+"""
+
+import os
+import sqlite3
+from datetime import datetime
+
+# Column order is the on-disk and export order
+BILL_COLUMNS = [
+    "urn",
+    "start_date",
+    "end_date",
+    "usage_amount",
+    "usage_unit",
+    "cost_amount",
+    "cost_unit",
+    "time_interval",
+    "fetched_at",
+    "version",
+]
+
+SEGMENT_COLUMNS = [
+    "urn",
+    "bill_urn",
+    "start_date",
+    "end_date",
+    "service_type",
+    "estimated",
+    "usage_amount",
+    "usage_unit",
+    "usage_charges",
+    "current_amount",
+    "fetched_at",
+    "version",
+]
+
+TABLES = {
+    "bills": BILL_COLUMNS,
+    "segments": SEGMENT_COLUMNS,
+}
+
+# SQLite column types, anything not listed is TEXT
+NUMERIC_COLUMNS = {"usage_amount", "cost_amount", "usage_charges", "current_amount"}
+BOOLEAN_COLUMNS = {"estimated"}
+INTEGER_COLUMNS = {"version"}
+
+# Bookkeeping columns that do not count as a change of the row's values
+UNVERSIONED_COLUMNS = {"urn", "fetched_at", "version"}
+
+# Only requested by larger query profiles; a NULL from a smaller profile keeps the stored value
+PROFILE_OPTIONAL_COLUMNS = {"service_type", "estimated"}
+
+
+def split_interval(time_interval):
+    """Split an ISO "start/end" interval string into its two halves."""
+    if time_interval and '/' in time_interval:
+        start_date, end_date = time_interval.split('/', 1)
+        return start_date, end_date
+    return None, None
+
+
+class HistoryStore:
+    def __init__(self, path):
+        self.path = path
+        self._conn = None
+
+    def connect(self):
+        """Open the SQLite database and create the schema on first use."""
+        if self._conn is None:
+            directory = os.path.dirname(self.path)
+            if directory and not os.path.exists(directory):
+                os.makedirs(directory, mode=0o700)
+            self._conn = sqlite3.connect(self.path)
+            self._create_schema()
+        return self._conn
+
+    def close(self):
+        if self._conn is not None:
+            self._conn.close()
+            self._conn = None
+
+    def _create_schema(self):
+        for table, columns in TABLES.items():
+            column_defs = []
+            for column in columns:
+                if column == "urn":
+                    column_defs.append("urn TEXT PRIMARY KEY")
+                elif column in NUMERIC_COLUMNS:
+                    column_defs.append(f"{column} REAL")
+                elif column in BOOLEAN_COLUMNS or column in INTEGER_COLUMNS:
+                    column_defs.append(f"{column} INTEGER")
+                else:
+                    column_defs.append(f"{column} TEXT")
+            self._conn.execute(f"CREATE TABLE IF NOT EXISTS {table} ({', '.join(column_defs)})")
+            # Databases created before versioning get the column, with existing rows at version 0
+            existing = {row[1] for row in self._conn.execute(f"PRAGMA table_info({table})")}
+            if "version" not in existing:
+                self._conn.execute(f"ALTER TABLE {table} ADD COLUMN version INTEGER NOT NULL DEFAULT 0")
+            self._conn.execute(f"CREATE INDEX IF NOT EXISTS {table}_version ON {table} (version)")
+        self._conn.execute("CREATE INDEX IF NOT EXISTS bills_start ON bills (start_date)")
+        self._conn.execute("CREATE INDEX IF NOT EXISTS segments_start ON segments (start_date)")
+        self._conn.execute("CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value INTEGER)")
+        self._conn.execute("INSERT OR IGNORE INTO meta (key, value) VALUES ('version', 0)")
+        self._conn.commit()
+
+    def current_version(self):
+        """Version of the latest write that changed any row."""
+        return self.connect().execute("SELECT value FROM meta WHERE key = 'version'").fetchone()[0]
+
+    def record(self, bill_rows, segment_rows):
+        """Upsert processed bill and segment rows (dicts keyed by column name).
+
+        New rows and rows whose values changed get the next version; returns
+        the store version after the write.
+        """
+        conn = self.connect()
+        fetched_at = datetime.now().isoformat()
+        with conn:
+            # Take the write lock before reading the counter so concurrent workers cannot reuse a version
+            conn.execute("BEGIN IMMEDIATE")
+            version = self.current_version() + 1
+            changed = 0
+            for table, rows in (("bills", bill_rows), ("segments", segment_rows)):
+                columns = TABLES[table]
+                placeholders = ", ".join("?" for _ in columns)
+                new_values = {
+                    column: f"COALESCE(excluded.{column}, {column})" if column in PROFILE_OPTIONAL_COLUMNS
+                    else f"excluded.{column}"
+                    for column in columns if column not in UNVERSIONED_COLUMNS
+                }
+                difference = " OR ".join(f"{value} IS NOT {column}" for column, value in new_values.items())
+                updates = ", ".join(
+                    [f"{column} = {value}" for column, value in new_values.items()]
+                    + ["fetched_at = excluded.fetched_at",
+                       f"version = CASE WHEN {difference} THEN excluded.version ELSE version END"]
+                )
+                sql = (f"INSERT INTO {table} ({', '.join(columns)}) VALUES ({placeholders}) "
+                       f"ON CONFLICT(urn) DO UPDATE SET {updates}")
+                conn.executemany(sql, (
+                    [fetched_at if column == "fetched_at" else version if column == "version" else row.get(column)
+                     for column in columns]
+                    for row in rows
+                    if row.get("urn")
+                ))
+                changed += conn.execute(f"SELECT COUNT(*) FROM {table} WHERE version = ?", (version,)).fetchone()[0]
+            # Unchanged refreshes leave the version alone, so cursors only move when data does
+            if changed:
+                conn.execute("UPDATE meta SET value = ? WHERE key = 'version'", (version,))
+                return version
+            return version - 1
+
+    def changes_since(self, table, since=0, until=None, columns=None):
+        """Rows of table (as dicts) changed after version since and up to until, oldest first."""
+        columns = self.resolve_columns(table, columns)
+        until = self.current_version() if until is None else until
+        cursor = self.connect().execute(
+            f"SELECT {', '.join(columns)} FROM {table} WHERE version > ? AND version <= ? ORDER BY start_date, urn",
+            (since, until)
+        )
+        try:
+            return [dict(zip(columns, row)) for row in cursor]
+        finally:
+            cursor.close()
+
+    def resolve_columns(self, table, columns=None):
+        """Validate a column projection against a table; None means all columns."""
+        if table not in TABLES:
+            raise ValueError(f"Unknown table '{table}'. Expected one of: {', '.join(TABLES)}")
+        if not columns:
+            return list(TABLES[table])
+        unknown = [column for column in columns if column not in TABLES[table]]
+        if unknown:
+            raise ValueError(f"Unknown column(s) for {table}: {', '.join(unknown)}")
+        return list(columns)
+
+    def iter_rows(self, table, columns=None, start=None, end=None, batch_size=500):
+        """Yield tuples for the projected columns, oldest first.
+
+        start and end are ISO dates (or datetimes) compared against the
+        period start date, so rows are streamed from SQLite in batches
+        rather than loaded all at once.
+        """
+        columns = self.resolve_columns(table, columns)
+        conditions = []
+        params = []
+        if start:
+            conditions.append("start_date >= ?")
+            params.append(start)
+        if end:
+            # Include every period starting on the end date itself
+            conditions.append("start_date < ?")
+            params.append(end if 'T' in end else f"{end}T99")
+        where = f" WHERE {' AND '.join(conditions)}" if conditions else ""
+        cursor = self.connect().execute(
+            f"SELECT {', '.join(columns)} FROM {table}{where} ORDER BY start_date, urn",
+            params
+        )
+        try:
+            while True:
+                rows = cursor.fetchmany(batch_size)
+                if not rows:
+                    break
+                for row in rows:
+                    yield row
+        finally:
+            cursor.close()
@@ -0,0 +1,212 @@
+#!/usr/bin/env python3
+"""
+Browserless National Grid login using the Azure AD B2C authorization-code
+flow with PKCE. It fills the same self-asserted sign-in form the browser
+does, then redeems the authorization code for an access token.
+
+The B2C client id, policy and scope are not published, so they are
+discovered from the access token of a previous browser login (see
+discover_login_config) and can be overridden with environment variables:
+
+  NG_B2C_AUTHORITY      e.g. https://login.nationalgrid.com (or a local stand-in IdP)
+  NG_B2C_TENANT         tenant name or id
+  NG_B2C_POLICY         sign-in user flow / custom policy
+  NG_B2C_CLIENT_ID      application (client) id of the My Account web app
+  NG_B2C_SCOPE          API scope the opower token is issued for
+  NG_B2C_REDIRECT_URI   registered redirect URI of the web app
+"""
+
+import aiohttp
+import base64
+import hashlib
+import json
+import os
+import re
+import secrets
+import time
+from urllib.parse import urlencode, urlsplit, parse_qs
+
+DEFAULT_REDIRECT_URI = "https://myaccount.nationalgrid.com/auth-landing"
+
+ENV_OVERRIDES = {
+    "authority": "NG_B2C_AUTHORITY",
+    "tenant": "NG_B2C_TENANT",
+    "policy": "NG_B2C_POLICY",
+    "client_id": "NG_B2C_CLIENT_ID",
+    "scope": "NG_B2C_SCOPE",
+    "redirect_uri": "NG_B2C_REDIRECT_URI",
+}
+
+REQUIRED_KEYS = ("authority", "tenant", "policy", "client_id", "scope")
+
+# The sign-in page embeds its state as "var SETTINGS = {...};"
+SETTINGS_PATTERN = re.compile(r'var\s+SETTINGS\s*=\s*(\{.*?\});', re.DOTALL)
+
+USER_AGENT = 'Mozilla/5.0 (X11; Linux x86_64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/120.0.0.0 Safari/537.36'
+
+
+class LoginError(Exception):
+    """Raised when a step of the HTTP login flow fails."""
+
+
+def decode_jwt_payload(token):
+    """Decode the payload of a JWT without verifying it; None if it is malformed."""
+    try:
+        parts = token.split('.')
+        if len(parts) != 3:
+            return None
+        payload = parts[1]
+        # Add padding if needed for base64 decoding
+        payload += '=' * (-len(payload) % 4)
+        return json.loads(base64.urlsafe_b64decode(payload))
+    except Exception:
+        return None
+
+
+def discover_login_config(access_token, msal_entry=None):
+    """Derive the B2C login settings from a browser-issued access token.
+
+    The issuer gives the authority and tenant, tfp/acr the policy and azp
+    the client id. The scope comes from the MSAL cache entry's target.
+    """
+    claims = decode_jwt_payload(access_token) or {}
+    config = {}
+
+    issuer = urlsplit(claims.get('iss', ''))
+    issuer_path = [part for part in issuer.path.split('/') if part]
+    if issuer.scheme and issuer.netloc and issuer_path:
+        config["authority"] = f"{issuer.scheme}://{issuer.netloc}"
+        config["tenant"] = issuer_path[0]
+
+    policy = claims.get('tfp') or claims.get('acr')
+    if policy:
+        config["policy"] = policy
+    if claims.get('azp'):
+        config["client_id"] = claims['azp']
+
+    target = (msal_entry or {}).get('target')
+    if target:
+        # MSAL stores every granted scope; the API scope is the one that is a URL
+        api_scopes = [scope for scope in target.split() if '://' in scope]
+        config["scope"] = ' '.join(api_scopes) or target
+
+    return config
+
+
+def resolve_login_config(discovered=None):
+    """Merge discovered settings with environment overrides; None if incomplete."""
+    config = {"redirect_uri": DEFAULT_REDIRECT_URI}
+    config.update({key: value for key, value in (discovered or {}).items() if value})
+    for key, env_name in ENV_OVERRIDES.items():
+        if os.getenv(env_name):
+            config[key] = os.getenv(env_name)
+    if not all(config.get(key) for key in REQUIRED_KEYS):
+        return None
+    config["authority"] = config["authority"].rstrip('/')
+    return config
+
+
+def make_pkce_pair():
+    """Return a (code_verifier, code_challenge) pair using the S256 method."""
+    verifier = base64.urlsafe_b64encode(secrets.token_bytes(32)).rstrip(b'=').decode()
+    challenge = base64.urlsafe_b64encode(hashlib.sha256(verifier.encode()).digest()).rstrip(b'=').decode()
+    return verifier, challenge
+
+
+def parse_settings(html):
+    """Extract the B2C SETTINGS object (csrf token, transaction id, ...) from a sign-in page."""
+    match = SETTINGS_PATTERN.search(html)
+    if not match:
+        raise LoginError("Sign-in page did not contain B2C settings")
+    try:
+        settings = json.loads(match.group(1))
+    except ValueError as e:
+        raise LoginError(f"Could not parse B2C settings: {e}")
+    if not settings.get('csrf') or not settings.get('transId'):
+        raise LoginError("B2C settings are missing csrf or transId")
+    return settings
+
+
+async def http_login(username, password, config, timeout=30):
+    """Run the authorization-code + PKCE flow and return the token response.
+
+    A private session (and cookie jar) is used so B2C cookies never leak
+    into the shared API session.
+    """
+    base = f"{config['authority']}/{config['tenant']}/{config['policy']}"
+    scope = f"openid offline_access {config['scope']}"
+    verifier, challenge = make_pkce_pair()
+    state = secrets.token_urlsafe(16)
+
+    client_timeout = aiohttp.ClientTimeout(total=timeout)
+    async with aiohttp.ClientSession(timeout=client_timeout, headers={'User-Agent': USER_AGENT}) as session:
+        # Step 1: Authorization request renders the sign-in page
+        authorize_params = {
+            "client_id": config["client_id"],
+            "response_type": "code",
+            "redirect_uri": config["redirect_uri"],
+            "response_mode": "query",
+            "scope": scope,
+            "state": state,
+            "nonce": secrets.token_urlsafe(16),
+            "code_challenge": challenge,
+            "code_challenge_method": "S256",
+        }
+        async with session.get(f"{base}/oauth2/v2.0/authorize?{urlencode(authorize_params)}") as resp:
+            if resp.status != 200:
+                raise LoginError(f"Authorize request failed: HTTP {resp.status}")
+            settings = parse_settings(await resp.text())
+
+        transaction = {"tx": settings["transId"], "p": config["policy"]}
+        csrf_headers = {"X-CSRF-TOKEN": settings["csrf"], "X-Requested-With": "XMLHttpRequest"}
+
+        # Step 2: Post the credentials to the self-asserted sign-in step
+        form = {"request_type": "RESPONSE", "signInName": username, "password": password}
+        async with session.post(f"{base}/SelfAsserted?{urlencode(transaction)}", data=form, headers=csrf_headers) as resp:
+            body = await resp.text()
+            try:
+                status = json.loads(body).get('status')
+            except ValueError:
+                status = None
+            if resp.status != 200 or status != "200":
+                raise LoginError(f"Credentials were rejected (HTTP {resp.status}, status {status})")
+
+        # Step 3: Confirm the sign-in; B2C answers with a redirect carrying the code
+        confirm_params = {"rememberMe": "false", "csrf_token": settings["csrf"], **transaction}
+        api = settings.get('api') or "CombinedSigninAndSignup"
+        async with session.get(f"{base}/api/{api}/confirmed?{urlencode(confirm_params)}", allow_redirects=False) as resp:
+            location = resp.headers.get('Location', '')
+        query = parse_qs(urlsplit(location).query)
+        if query.get('error'):
+            raise LoginError(f"Authorization failed: {query.get('error_description', query['error'])[0]}")
+        if query.get('state', [None])[0] != state or not query.get('code'):
+            raise LoginError("Authorization redirect did not contain a valid code")
+
+        # Step 4: Redeem the code with the PKCE verifier
+        token_form = {
+            "grant_type": "authorization_code",
+            "client_id": config["client_id"],
+            "code": query['code'][0],
+            "code_verifier": verifier,
+            "redirect_uri": config["redirect_uri"],
+            "scope": scope,
+        }
+        async with session.post(f"{base}/oauth2/v2.0/token", data=token_form) as resp:
+            if resp.status != 200:
+                raise LoginError(f"Token request failed: HTTP {resp.status}")
+            token_response = await resp.json(content_type=None)
+
+    access_token = token_response.get('access_token')
+    if not access_token:
+        raise LoginError("Token response did not contain an access token")
+
+    expires_on = token_response.get('expires_on')
+    if not expires_on and token_response.get('expires_in'):
+        expires_on = int(time.time()) + int(token_response['expires_in'])
+
+    tokens = {"access_token": access_token}
+    if expires_on:
+        tokens["expires_on"] = int(expires_on)
+    if token_response.get('refresh_token'):
+        tokens["refresh_token"] = token_response['refresh_token']
+    return tokens
@@ -0,0 +1,430 @@
+#!/usr/bin/env python3
+"""
+Load test for the HTTP API against the offline stand-in services.
+Usage: python3 loadtest.py [--modes on_demand,adaptive,gunicorn] [--concurrency 1,8,32]
+                           [--rate 0] [--duration 20] [--paths /usage=9,/health=1]
+                           [--upstream-latency-ms 200] [--output results.json]
+
+A stand-in identity provider and opower.com (standin.py serve) are started
+first; then, for every serving mode, a fresh API server with its own data
+directory is started against them, warmed up with one /usage call and
+driven at each concurrency level. Each run reports throughput, latency
+percentiles, error rate, upstream calls and the server's RSS and CPU,
+sampled once per interval from /proc.
+
+With --rate 0 every client sends its next request as soon as the previous
+one finishes (closed loop). With --rate R requests are started at a fixed
+R per second, at most --concurrency at a time, and latency is measured
+from when each request was due, so a stalled server cannot hide its
+queueing delay.
+"""
+
+import argparse
+import asyncio
+import json
+import math
+import os
+import random
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+
+import aiohttp
+
+try:
+    from .driver_pool import process_tree_pids
+except ImportError:
+    from driver_pool import process_tree_pids
+
+APP_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+INTERNAL_DIR = os.path.join(APP_DIR, "internal")
+
+STANDIN_USERNAME = "loadtest@example.com"
+STANDIN_PASSWORD = "loadtest"
+
+# Serving modes: environment for the API server and the number of gunicorn workers (1 = flask run)
+MODES = {
+    "on_demand": {"env": {"NGNYC_POLLING": "on_demand"}, "workers": 1},
+    "on_demand_uncached": {"env": {"NGNYC_POLLING": "on_demand", "NGNYC_RESULT_TTL": "0"}, "workers": 1},
+    "adaptive": {"env": {"NGNYC_POLLING": "adaptive"}, "workers": 1},
+    "gunicorn": {"env": {"NGNYC_POLLING": "on_demand"}, "workers": None},
+    "gunicorn_adaptive": {"env": {"NGNYC_POLLING": "adaptive"}, "workers": None},
+}
+
+CLOCK_TICKS = os.sysconf('SC_CLK_TCK')
+PAGE_SIZE = os.sysconf('SC_PAGE_SIZE')
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def parse_paths(value):
+    """Parse "/usage=9,/health=1" into [(path, weight), ...]."""
+    paths = []
+    for item in value.split(','):
+        path, _, weight = item.strip().partition('=')
+        paths.append((path, float(weight or 1)))
+    return paths
+
+
+def process_tree_stats(root_pid):
+    """Total RSS (kB) and CPU time (clock ticks) of a process and all of its descendants."""
+    rss_kb = cpu_ticks = 0
+    for pid in process_tree_pids(root_pid):
+        try:
+            with open(f'/proc/{pid}/stat', 'r') as f:
+                fields = f.read().rsplit(')', 1)[1].split()
+        except (OSError, IndexError):
+            continue
+        # After the command name: state, ppid, ... utime (14th field), stime (15th), ... rss (24th, in pages)
+        rss_kb += int(fields[21]) * PAGE_SIZE // 1024
+        cpu_ticks += int(fields[11]) + int(fields[12])
+    return rss_kb, cpu_ticks
+
+
+def percentile(sorted_values, fraction):
+    """Nearest-rank percentile of an already sorted list."""
+    if not sorted_values:
+        return None
+    index = min(len(sorted_values) - 1, max(0, math.ceil(fraction * len(sorted_values)) - 1))
+    return sorted_values[index]
+
+
+def latency_summary(latencies):
+    values = sorted(latencies)
+    return {
+        "p50_ms": percentile(values, 0.50),
+        "p90_ms": percentile(values, 0.90),
+        "p99_ms": percentile(values, 0.99),
+        "max_ms": values[-1] if values else None,
+    }
+
+
+class Server:
+    """A subprocess started with its own environment, stopped with its whole process group."""
+
+    def __init__(self, command, env, cwd, log_path):
+        self.log = open(log_path, 'w')
+        self.process = subprocess.Popen(
+            command, env=env, cwd=cwd, stdout=self.log, stderr=subprocess.STDOUT, start_new_session=True
+        )
+
+    @property
+    def pid(self):
+        return self.process.pid
+
+    def stop(self):
+        if self.process.poll() is None:
+            os.killpg(self.process.pid, 15)
+            try:
+                self.process.wait(timeout=10)
+            except subprocess.TimeoutExpired:
+                os.killpg(self.process.pid, 9)
+                self.process.wait()
+        self.log.close()
+
+
+async def wait_until_up(url, server, timeout=60):
+    deadline = time.monotonic() + timeout
+    async with aiohttp.ClientSession() as session:
+        while time.monotonic() < deadline:
+            if server.process.poll() is not None:
+                raise RuntimeError(f"Server exited with code {server.process.returncode}; see {server.log.name}")
+            try:
+                async with session.get(url) as resp:
+                    if resp.status < 500:
+                        return
+            except aiohttp.ClientError:
+                pass
+            await asyncio.sleep(0.2)
+    raise RuntimeError(f"{url} did not come up within {timeout}s; see {server.log.name}")
+
+
+async def fetch_json(url):
+    async with aiohttp.ClientSession() as session:
+        async with session.get(url) as resp:
+            return await resp.json(content_type=None)
+
+
+async def sample_process(pid, interval, samples, stop):
+    """Append one {t, rss_mb, cpu_percent} sample per interval until stop is set."""
+    started = time.monotonic()
+    _, last_ticks = process_tree_stats(pid)
+    last_time = started
+    while not stop.is_set():
+        try:
+            await asyncio.wait_for(stop.wait(), interval)
+        except asyncio.TimeoutError:
+            pass
+        now = time.monotonic()
+        rss_kb, ticks = process_tree_stats(pid)
+        samples.append({
+            "t": round(now - started, 2),
+            "rss_mb": round(rss_kb / 1024, 1),
+            "cpu_percent": round(100 * (ticks - last_ticks) / CLOCK_TICKS / max(now - last_time, 1e-6), 1),
+        })
+        last_ticks, last_time = ticks, now
+
+
+async def drive(base_url, paths, concurrency, rate, duration, timeout):
+    """Send requests for duration seconds; returns one (t, path, latency_ms, ok) tuple per request."""
+    results = []
+    names = [path for path, _ in paths]
+    weights = [weight for _, weight in paths]
+    client_timeout = aiohttp.ClientTimeout(total=timeout)
+    connector = aiohttp.TCPConnector(limit=concurrency)
+
+    async with aiohttp.ClientSession(timeout=client_timeout, connector=connector) as session:
+        started = time.monotonic()
+        deadline = started + duration
+
+        async def one(path, due):
+            ok = False
+            try:
+                async with session.get(base_url + path) as resp:
+                    body = await resp.read()
+                    # /usage answers HTTP 200 with "success": false when upstream fails
+                    ok = resp.status < 400 and b'"success": false' not in body and b'"success":false' not in body
+            except (aiohttp.ClientError, asyncio.TimeoutError):
+                pass
+            finished = time.monotonic()
+            results.append((round(finished - started, 3), path, (finished - due) * 1000, ok))
+
+        if rate <= 0:
+            async def client():
+                while time.monotonic() < deadline:
+                    await one(random.choices(names, weights)[0], time.monotonic())
+
+            await asyncio.gather(*(client() for _ in range(concurrency)))
+        else:
+            in_flight = asyncio.Semaphore(concurrency)
+            tasks = []
+
+            async def limited(path, due):
+                async with in_flight:
+                    await one(path, due)
+
+            sent = 0
+            while True:
+                due = started + sent / rate
+                if due >= deadline:
+                    break
+                if due > time.monotonic():
+                    await asyncio.sleep(due - time.monotonic())
+                tasks.append(asyncio.ensure_future(limited(random.choices(names, weights)[0], due)))
+                sent += 1
+            await asyncio.gather(*tasks)
+
+    return results
+
+
+def summarize_run(results, samples, duration, upstream_calls):
+    """Aggregate request results and process samples of one run."""
+    total = len(results)
+    errors = sum(1 for _, _, _, ok in results if not ok)
+    by_path = {}
+    for _, path, latency, ok in results:
+        entry = by_path.setdefault(path, {"latencies": [], "errors": 0})
+        entry["latencies"].append(latency)
+        entry["errors"] += 0 if ok else 1
+
+    # Per-second throughput and tail latency, next to the process samples
+    timeline = {}
+    for t, _, latency, ok in results:
+        second = timeline.setdefault(int(t), {"requests": 0, "errors": 0, "latencies": []})
+        second["requests"] += 1
+        second["errors"] += 0 if ok else 1
+        second["latencies"].append(latency)
+
+    rss = [sample["rss_mb"] for sample in samples]
+    cpu = [sample["cpu_percent"] for sample in samples]
+    return {
+        "requests": total,
+        "throughput_rps": round(total / duration, 1),
+        "error_rate": round(errors / total, 4) if total else None,
+        **{key: round(value, 1) if value is not None else None for key, value in latency_summary([r[2] for r in results]).items()},
+        "rss_mb_avg": round(sum(rss) / len(rss), 1) if rss else None,
+        "rss_mb_max": max(rss) if rss else None,
+        "cpu_percent_avg": round(sum(cpu) / len(cpu), 1) if cpu else None,
+        "upstream_calls": upstream_calls,
+        "paths": {
+            path: {
+                "requests": len(entry["latencies"]),
+                "errors": entry["errors"],
+                **{key: round(value, 1) for key, value in latency_summary(entry["latencies"]).items()},
+            }
+            for path, entry in by_path.items()
+        },
+        "timeline": [
+            {
+                "second": second,
+                "requests": entry["requests"],
+                "errors": entry["errors"],
+                "p99_ms": round(percentile(sorted(entry["latencies"]), 0.99), 1),
+            }
+            for second, entry in sorted(timeline.items())
+        ],
+        "process_samples": samples,
+    }
+
+
+def server_command(mode, port, gunicorn_workers):
+    workers = MODES[mode]["workers"] or gunicorn_workers
+    if workers > 1:
+        # Same invocation as run.sh uses for several workers
+        return ["gunicorn", "--workers", str(workers), "--bind", f"127.0.0.1:{port}", "--timeout", "300", "app:app"]
+    # Flask's threaded server as python3 app.py uses it, but without the reloader's second process
+    # (and its file polling) counted in the RSS and CPU samples
+    return [sys.executable, "-m", "flask", "--app", "app", "run", "--host", "127.0.0.1", "--port", str(port), "--no-reload"]
+
+
+async def run_mode(mode, args, standin_url, work_dir):
+    """Start the API in one serving mode and drive it at every concurrency level."""
+    port = free_port()
+    data_dir = os.path.join(work_dir, mode)
+    os.makedirs(data_dir, exist_ok=True)
+    env = dict(os.environ)
+    env.update({
+        # Token cache and history live under ~/.ngnycmetro, so each mode gets a fresh home
+        "HOME": data_dir,
+        "NGNYC_PORT": str(port),
+        "USERNAME": STANDIN_USERNAME,
+        "PASSWORD": STANDIN_PASSWORD,
+        "NGNYC_LOGIN_METHOD": "http",
+        "NGNYC_OPOWER_URL": standin_url,
+        "NG_B2C_AUTHORITY": standin_url,
+        "NG_B2C_TENANT": "standin",
+        "NG_B2C_POLICY": "B2C_1A_standin",
+        "NG_B2C_CLIENT_ID": "standin-client",
+        "NG_B2C_SCOPE": "https://standin/opower",
+    })
+    env.pop("NGNYC_REPLAY", None)
+    env.pop("NGNYC_RECORD", None)
+    env.update(MODES[mode]["env"])
+
+    server = Server(server_command(mode, port, args.gunicorn_workers), env, APP_DIR, os.path.join(work_dir, f"{mode}.log"))
+    base_url = f"http://127.0.0.1:{port}"
+    runs = []
+    try:
+        await wait_until_up(f"{base_url}/health", server)
+        # Warm up: log in once and fill the caches so every level measures steady state
+        warmup = await fetch_json(f"{base_url}/usage")
+        if not warmup.get("success"):
+            raise RuntimeError(f"Warm-up /usage failed: {warmup.get('error')}")
+
+        for concurrency in args.concurrency:
+            before = await fetch_json(f"{standin_url}/_standin/stats")
+            samples = []
+            stop = asyncio.Event()
+            sampler = asyncio.ensure_future(sample_process(server.pid, args.sample_interval, samples, stop))
+            results = await drive(base_url, args.paths, concurrency, args.rate, args.duration, args.timeout)
+            stop.set()
+            await sampler
+            after = await fetch_json(f"{standin_url}/_standin/stats")
+            upstream_calls = sum(after[key] - before.get(key, 0) for key in ("customer", "graphql"))
+
+            summary = summarize_run(results, samples, args.duration, upstream_calls)
+            runs.append({"mode": mode, "concurrency": concurrency, "rate": args.rate, **summary})
+            print_row(runs[-1])
+            if args.timeline:
+                print_timeline(runs[-1])
+    finally:
+        server.stop()
+    return runs
+
+
+HEADER = f"{'mode':<20} {'conc':>4} {'rps':>8} {'err%':>6} {'p50':>8} {'p90':>8} {'p99':>8} {'max':>8} {'rss MB':>8} {'cpu%':>6} {'upstream':>8}"
+
+
+def print_row(run):
+    def ms(value):
+        return f"{value:8.1f}" if value is not None else f"{'-':>8}"
+    error_percent = 100 * run['error_rate'] if run['error_rate'] is not None else 0
+    print(f"{run['mode']:<20} {run['concurrency']:>4} {run['throughput_rps']:>8.1f} {error_percent:>6.2f} "
+          f"{ms(run['p50_ms'])} {ms(run['p90_ms'])} {ms(run['p99_ms'])} {ms(run['max_ms'])} "
+          f"{ms(run['rss_mb_max'])} {run['cpu_percent_avg'] or 0:>6.1f} {run['upstream_calls']:>8}", flush=True)
+
+
+def print_timeline(run):
+    samples = run["process_samples"]
+    for second in run["timeline"]:
+        # The sample taken at the end of this second, or the last one for the tail of the run
+        sample = next((sample for sample in samples if sample["t"] >= second["second"] + 1), samples[-1] if samples else {})
+        print(f"    t={second['second']:>3}s  {second['requests']:>6} req  {second['errors']:>4} err  "
+              f"p99 {second['p99_ms']:>8.1f} ms  rss {sample.get('rss_mb', 0):>7.1f} MB  cpu {sample.get('cpu_percent', 0):>6.1f}%")
+
+
+def parse_args(argv):
+    parser = argparse.ArgumentParser(description="Load test the API in several serving modes against offline stand-ins.")
+    parser.add_argument("--modes", default="on_demand,adaptive,gunicorn",
+                        help=f"Comma separated serving modes: {', '.join(MODES)}")
+    parser.add_argument("--concurrency", default="1,8,32", help="Comma separated concurrency levels")
+    parser.add_argument("--rate", type=float, default=0, help="Requests per second (0 = closed loop, as fast as possible)")
+    parser.add_argument("--duration", type=float, default=20, help="Seconds per run")
+    parser.add_argument("--paths", default="/usage=9,/health=1", help="Weighted request mix, e.g. /usage=9,/health=1")
+    parser.add_argument("--timeout", type=float, default=60, help="Per-request timeout in seconds")
+    parser.add_argument("--gunicorn-workers", type=int, default=4, help="Workers for the gunicorn modes")
+    parser.add_argument("--bills", type=int, default=36, help="Synthetic bills served by the stand-in")
+    parser.add_argument("--fixture", help="Replay fixture for the stand-in instead of synthetic bills")
+    parser.add_argument("--upstream-latency-ms", type=float, default=200, help="Latency of every stand-in response")
+    parser.add_argument("--upstream-jitter-ms", type=float, default=0)
+    parser.add_argument("--sample-interval", type=float, default=1.0, help="Seconds between RSS/CPU samples")
+    parser.add_argument("--timeline", action="store_true", help="Print per-second throughput, p99, RSS and CPU")
+    parser.add_argument("--output", help="Write every run, including timelines, to this JSON file")
+
+    args = parser.parse_args(argv)
+    args.modes = [mode.strip() for mode in args.modes.split(',') if mode.strip()]
+    unknown = [mode for mode in args.modes if mode not in MODES]
+    if unknown:
+        parser.error(f"Unknown mode(s): {', '.join(unknown)}. Expected any of: {', '.join(MODES)}")
+    args.concurrency = [int(level) for level in args.concurrency.split(',')]
+    args.paths = parse_paths(args.paths)
+    return args
+
+
+async def main(argv=None):
+    args = parse_args(sys.argv[1:] if argv is None else argv)
+    work_dir = tempfile.mkdtemp(prefix="ngnyc-loadtest-")
+
+    standin_port = free_port()
+    standin_url = f"http://127.0.0.1:{standin_port}"
+    standin_command = [
+        sys.executable, os.path.join(INTERNAL_DIR, "standin.py"), "serve",
+        "--port", str(standin_port),
+        "--username", STANDIN_USERNAME, "--password", STANDIN_PASSWORD,
+        "--bills", str(args.bills),
+        "--latency-ms", str(args.upstream_latency_ms), "--jitter-ms", str(args.upstream_jitter_ms),
+    ]
+    if args.fixture:
+        standin_command += ["--fixture", os.path.abspath(args.fixture)]
+    standin = Server(standin_command, dict(os.environ), INTERNAL_DIR, os.path.join(work_dir, "standin.log"))
+
+    print(f"# Logs and data directories: {work_dir}", file=sys.stderr)
+    print(HEADER)
+    runs = []
+    failures = {}
+    try:
+        await wait_until_up(f"{standin_url}/_standin/stats", standin)
+        for mode in args.modes:
+            try:
+                runs.extend(await run_mode(mode, args, standin_url, work_dir))
+            except Exception as e:
+                failures[mode] = str(e)
+                print(f"{mode:<20} failed: {e}", flush=True)
+    finally:
+        standin.stop()
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump({"settings": {key: value for key, value in vars(args).items() if key != "output"},
+                       "runs": runs, "failures": failures}, f, indent=2)
+    return 1 if failures else 0
+
+
+if __name__ == "__main__":
+    sys.exit(asyncio.run(main()))
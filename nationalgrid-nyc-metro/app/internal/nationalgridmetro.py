@@ -2,15 +2,22 @@
 """
 Simplified National Grid Metro NYC energy data retrieval script.
 Usage: python3 nationalgridmetro.py username password
+       python3 nationalgridmetro.py --export csv|parquet|arrow [--table bills|segments]
+       python3 nationalgridmetro.py --batch credentials.jsonl [--batch-output results.jsonl]
+       python3 nationalgridmetro.py username password --record fixture.json
+       python3 nationalgridmetro.py --replay fixture.json [--replay-latency-ms 200]
 Returns: JSON with energy usage and cost data
 """
 
+import argparse
 import asyncio
 import aiohttp
 import json
 import sys
 import os
-import base64
+import functools
+import hashlib
+from contextlib import asynccontextmanager
 from datetime import datetime, timedelta
 from selenium import webdriver
 from selenium.webdriver.common.by import By
@@ -21,37 +28,154 @@ from selenium.webdriver.chrome.service import Service
 from selenium.webdriver.common.keys import Keys
 import time
 
+try:
+    from .history import HistoryStore, split_interval
+    from .fixtures import RecordingTransport, ReplayTransport, transport_from_env
+    from .shared_cache import atomic_write_json, read_json
+    from .driver_pool import driver_manager_from_env
+    from .httplogin import LoginError, decode_jwt_payload, discover_login_config, http_login, resolve_login_config
+    from .queries import BILLS_QUERIES, DEFAULT_PROFILE, FIELD_OUTPUT_KEYS, QUERY_PROFILES, parse_fields, select_profile
+    from .tracing import span
+    from .records import UsagePeriod
+    from .health import TOKEN_EXPIRY_BUFFER, CircuitOpenError, token_expiry, upstream_health
+except ImportError:
+    from history import HistoryStore, split_interval
+    from fixtures import RecordingTransport, ReplayTransport, transport_from_env
+    from shared_cache import atomic_write_json, read_json
+    from driver_pool import driver_manager_from_env
+    from httplogin import LoginError, decode_jwt_payload, discover_login_config, http_login, resolve_login_config
+    from queries import BILLS_QUERIES, DEFAULT_PROFILE, FIELD_OUTPUT_KEYS, QUERY_PROFILES, parse_fields, select_profile
+    from tracing import span
+    from records import UsagePeriod
+    from health import TOKEN_EXPIRY_BUFFER, CircuitOpenError, token_expiry, upstream_health
+
+# Runs inside the page after login. Applies the same key heuristics the Python side used to
+# (MSAL access-token entries, *access_token* keys, bare JWTs) over localStorage then
+# sessionStorage, and returns only the token, its expiry and the MSAL scope.
+TOKEN_EXTRACTION_SCRIPT = """
+const stores = [[window.localStorage, false], [window.sessionStorage, true]];
+for (const [store, isSession] of stores) {
+    for (let i = 0; i < store.length; i++) {
+        const key = store.key(i);
+        const value = store.getItem(key);
+        if (!value) continue;
+        const lower = key.toLowerCase();
+        if (lower.includes('accesstoken') && (isSession || lower.includes('opower') || lower.includes('nationalgrid'))) {
+            try {
+                const entry = JSON.parse(value);
+                if (entry.secret) {
+                    return {secret: entry.secret, expiresOn: entry.expiresOn || null, target: entry.target || null};
+                }
+            } catch (e) {}
+            continue;
+        }
+        if (lower.includes('access_token')) {
+            let token = value;
+            if (value.startsWith('{')) {
+                try {
+                    const data = JSON.parse(value);
+                    token = data.access_token || data.secret;
+                } catch (e) {
+                    token = null;
+                }
+            }
+            if (token) return {secret: token, expiresOn: null, target: null};
+            continue;
+        }
+        if (value.startsWith('ey') && value.length > 100) {
+            return {secret: value, expiresOn: null, target: null};
+        }
+    }
+}
+return {secret: null, localCount: window.localStorage.length, sessionCount: window.sessionStorage.length};
+"""
+
 class NationalGridMetroClient:
-    def __init__(self):
+    def __init__(self, cache_key=None, session=None, transport=None):
         self.subdomain = "ngny-gas"
-        self.base_url = f"https://{self.subdomain}.opower.com"
+        # NGNYC_OPOWER_URL points the client at a stand-in (see standin.py opower)
+        self.base_url = os.getenv('NGNYC_OPOWER_URL') or f"https://{self.subdomain}.opower.com"
         self.auth_url = "https://myaccount.nationalgrid.com"
         self.tokens = None
         self.customer_urn = None
+        # B2C settings for the browserless login, discovered from a browser login
+        self.login_config = None
         self.token_cache_dir = os.path.expanduser("~/.ngnycmetro")
-        self.token_file = os.path.join(self.token_cache_dir, "tokens.json")
+        # Per-account cache files when several accounts share the cache directory
+        suffix = f"-{hashlib.sha256(cache_key.encode()).hexdigest()[:16]}" if cache_key else ""
+        self.token_file = os.path.join(self.token_cache_dir, f"tokens{suffix}.json")
+        self.history_file = os.path.join(self.token_cache_dir, f"history{suffix}.db")
+        self._history = None
+        # Optional shared aiohttp session, owned by the caller
+        self.session = session
+        # Optional record/replay transport (see fixtures.py), configurable from the environment
+        self.transport = transport if transport is not None else transport_from_env()
+        # Optional warm browser shared by every client in the process (NGNYC_DRIVER_POOL)
+        self.driver_manager = driver_manager_from_env(self.create_driver)
+        # Upstream latency, token expiry and circuit state for /ready (see health.py)
+        self.health = upstream_health(self.token_cache_dir)
 
     def ensure_cache_dir(self):
         """Ensure the token cache directory exists."""
         if not os.path.exists(self.token_cache_dir):
             os.makedirs(self.token_cache_dir, mode=0o700)
 
+    @asynccontextmanager
+    async def _session(self):
+        """Yield the shared aiohttp session if one was given, otherwise a new one."""
+        if self.session is not None:
+            yield self.session
+        else:
+            async with aiohttp.ClientSession() as session:
+                yield session
+
+    async def _send(self, method, url, headers, payload=None):
+        """Send an HTTP request over aiohttp and return (status, body text)."""
+        async with self._session() as session:
+            async with session.request(method, url, headers=headers, json=payload) as resp:
+                return resp.status, await resp.text()
+
+    async def _request(self, method, url, headers, payload=None):
+        """Send a request through the configured transport, if any."""
+        # Fail fast instead of piling more requests onto a failing upstream
+        self.health.check_circuit()
+        with span("http.request", method=method, url=url.split('?', 1)[0]) as request_span:
+            started = time.perf_counter()
+            try:
+                if self.transport is not None:
+                    status, body = await self.transport.request(self._send, method, url, headers, payload)
+                else:
+                    status, body = await self._send(method, url, headers, payload)
+            except BaseException as e:
+                # Cancellations count too, so a cancelled half-open trial cannot leave the circuit stuck
+                self.health.record_request(latency_ms=(time.perf_counter() - started) * 1000,
+                                           error=f"{type(e).__name__}: {e}")
+                raise
+            self.health.record_request(status, (time.perf_counter() - started) * 1000)
+            if request_span is not None:
+                request_span.set(status=status, response_bytes=len(body))
+            return status, body
+
+    @property
+    def is_offline(self):
+        """True when responses are replayed from fixtures instead of opower.com."""
+        return getattr(self.transport, 'offline', False)
+
+    @property
+    def history(self):
+        """Bill and segment history store, opened on first use."""
+        if self._history is None:
+            self._history = HistoryStore(self.history_file)
+        return self._history
+
     def is_token_expired(self, token):
         """Check if a JWT token is expired."""
         try:
-            # JWT tokens have 3 parts separated by dots
-            parts = token.split('.')
-            if len(parts) != 3:
+            # JWT tokens have 3 parts separated by dots; the payload is base64url encoded
+            payload_data = decode_jwt_payload(token)
+            if not payload_data:
                 return True
             
-            # Decode the payload (second part)
-            payload = parts[1]
-            # Add padding if needed for base64 decoding
-            payload += '=' * (4 - len(payload) % 4)
-            
-            decoded = base64.b64decode(payload)
-            payload_data = json.loads(decoded)
-            
             # Check expiration time (exp field is in seconds since epoch)
             exp_timestamp = payload_data.get('exp')
             if not exp_timestamp:
@@ -67,32 +191,73 @@ class NationalGridMetroClient:
 
     def save_tokens(self, tokens):
         """Save tokens to cache file."""
+        if self.is_offline:
+            # Replayed sessions use a placeholder token that must never reach the real cache
+            return True
         try:
             self.ensure_cache_dir()
             cache_data = {
                 'tokens': tokens,
                 'saved_at': datetime.now().isoformat(),
-                'customer_urn': self.customer_urn
+                'customer_urn': self.customer_urn,
+                'login_config': self.load_login_config()
             }
             
-            with open(self.token_file, 'w') as f:
-                json.dump(cache_data, f, indent=2)
-            
-            # Set secure permissions
-            os.chmod(self.token_file, 0o600)
+            # Write atomically with secure permissions so concurrent workers never read a partial file
+            atomic_write_json(self.token_file, cache_data, mode=0o600)
+            self.health.record_tokens(tokens, bool(resolve_login_config(cache_data['login_config'])))
+            # Have the warm browser ready again when this token stops being reused
+            self.schedule_browser_prestart(self.next_login_at())
             return True
         except Exception as e:
             print(f"Warning: Could not save tokens: {e}", file=sys.stderr)
             return False
 
+    def refresh_health(self):
+        """Seed token expiry and login readiness in the health state from the token cache."""
+        cache_data = read_json(self.token_file) or {}
+        # Replayed sessions can always log in
+        login_configured = self.is_offline or bool(resolve_login_config(self.load_login_config()))
+        self.health.record_tokens(cache_data.get('tokens'), login_configured)
+
+    def next_login_at(self):
+        """Epoch time from which the cached token is no longer reused; now if there is none."""
+        expires_at = token_expiry((read_json(self.token_file) or {}).get('tokens'))
+        return expires_at - TOKEN_EXPIRY_BUFFER if expires_at else time.time()
+
+    def needs_browser_login(self):
+        """True if the next login is expected to go through Selenium rather than the HTTP flow."""
+        method = os.getenv('NGNYC_LOGIN_METHOD', 'auto').lower()
+        if method == 'http':
+            return False
+        if method != 'auto':
+            return True
+        return not resolve_login_config(self.load_login_config())
+
+    def schedule_browser_prestart(self, login_at):
+        """Warm the pooled browser shortly before a login at login_at (epoch seconds); None cancels."""
+        if self.driver_manager is None or self.is_offline:
+            return
+        if login_at is not None and not self.needs_browser_login():
+            login_at = None
+        self.driver_manager.prestart_at(login_at)
+
+    def load_login_config(self):
+        """Return the discovered B2C login settings, reading them from the cache file if needed."""
+        if self.login_config is None:
+            cache_data = read_json(self.token_file) or {}
+            self.login_config = cache_data.get('login_config') or {}
+        return self.login_config
+
     def load_tokens(self):
         """Load tokens from cache file if they exist and are valid."""
         try:
             if not os.path.exists(self.token_file):
                 return None
             
-            with open(self.token_file, 'r') as f:
-                cache_data = json.load(f)
+            cache_data = read_json(self.token_file)
+            if not cache_data:
+                return None
             
             tokens = cache_data.get('tokens', {})
             access_token = tokens.get('access_token')
@@ -100,13 +265,9 @@ class NationalGridMetroClient:
             if not access_token:
                 return None
             
-            # Check if token is expired
+            # Check if token is expired; the file is left for the next login to replace,
+            # since another worker may be writing fresh tokens right now
             if self.is_token_expired(access_token):
-                # Clean up expired token
-                try:
-                    os.remove(self.token_file)
-                except:
-                    pass
                 return None
             
             # Token is valid, restore state
@@ -119,188 +280,215 @@ class NationalGridMetroClient:
                 'saved_at': cache_data.get('saved_at')
             }
             
-        except Exception as e:
-            # If there's any error reading the cache, remove it and continue with fresh login
-            try:
-                os.remove(self.token_file)
-            except:
-                pass
+        except Exception:
+            # If there's any error reading the cache, continue with fresh login
             return None
 
     async def login_and_get_tokens(self, username: str, password: str):
+        """Log in and get tokens, preferring the browserless HTTP flow.
+        
+        NGNYC_LOGIN_METHOD selects "auto" (HTTP, falling back to Selenium),
+        "http" (no fallback) or "selenium".
+        """
+        if self.is_offline:
+            # Fixture replay needs no credentials; recorded responses carry no real token
+            self.tokens = {"access_token": self.transport.placeholder_token}
+            return {"success": True, "source": "replay"}
+        
+        method = os.getenv('NGNYC_LOGIN_METHOD', 'auto').lower()
+        if method in ('auto', 'http'):
+            with span("login.http"):
+                http_result = await self.http_login_and_get_tokens(username, password)
+            if http_result["success"] or method == 'http':
+                return http_result
+            print(f"# HTTP login failed, falling back to browser login: {http_result['error']}", file=sys.stderr)
+        
+        with span("login.browser"):
+            return await self.browser_login_and_get_tokens(username, password)
+
+    async def http_login_and_get_tokens(self, username: str, password: str):
+        """Browserless login using the B2C authorization-code + PKCE flow."""
+        config = resolve_login_config(self.load_login_config())
+        if not config:
+            return {"success": False, "error": "HTTP login is not configured; a browser login will discover its settings"}
+        
+        try:
+            self.tokens = await http_login(username, password, config)
+        except (LoginError, aiohttp.ClientError, asyncio.TimeoutError) as e:
+            return {"success": False, "error": f"HTTP login failed: {str(e) or type(e).__name__}"}
+        except Exception as e:
+            # An unexpected page or token response (bad JSON, missing keys) must still allow the browser fallback
+            return {"success": False, "error": f"HTTP login failed unexpectedly: {type(e).__name__}: {e}"}
+        
+        self.save_tokens(self.tokens)
+        return {"success": True, "source": "http_login"}
+
+    def create_driver(self):
+        """Start a headless Chrome WebDriver."""
+        # Setup Chrome options for headless operation
+        chrome_options = Options()
+        chrome_options.add_argument("--headless")
+        chrome_options.add_argument("--no-sandbox")
+        chrome_options.add_argument("--disable-dev-shm-usage")
+        chrome_options.add_argument("--disable-gpu")
+        chrome_options.add_argument("--disable-web-security")
+        chrome_options.add_argument("--allow-running-insecure-content")
+        chrome_options.add_argument("--disable-extensions")
+        chrome_options.add_argument("--user-agent=Mozilla/5.0 (X11; Linux x86_64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/120.0.0.0 Safari/537.36")
+        
+        # Set up Chrome service
+        chrome_service = None
+        if os.getenv('CHROMEDRIVER_PATH'):
+            chrome_service = Service(os.getenv('CHROMEDRIVER_PATH'))
+        
+        # Create driver
+        with span("browser.start"):
+            return webdriver.Chrome(service=chrome_service, options=chrome_options)
+
+    async def browser_login_and_get_tokens(self, username: str, password: str):
         """Automated login using Selenium to get tokens."""
         try:
-            # Setup Chrome options for headless operation
-            chrome_options = Options()
-            chrome_options.add_argument("--headless")
-            chrome_options.add_argument("--no-sandbox")
-            chrome_options.add_argument("--disable-dev-shm-usage")
-            chrome_options.add_argument("--disable-gpu")
-            chrome_options.add_argument("--disable-web-security")
-            chrome_options.add_argument("--allow-running-insecure-content")
-            chrome_options.add_argument("--disable-extensions")
-            chrome_options.add_argument("--user-agent=Mozilla/5.0 (X11; Linux x86_64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/120.0.0.0 Safari/537.36")
-            
-            # Set up Chrome service
-            chrome_service = None
-            if os.getenv('CHROMEDRIVER_PATH'):
-                chrome_service = Service(os.getenv('CHROMEDRIVER_PATH'))
+            if self.driver_manager is not None:
+                # Reuse the warm browser; it is reset before and health-checked after each login
+                with self.driver_manager.acquire() as driver:
+                    return await self._browser_login(driver, username, password)
             
             # Create driver
-            driver = webdriver.Chrome(service=chrome_service, options=chrome_options)
-            
+            driver = self.create_driver()
             try:
-                # Navigate to login page
-                login_url = f"{self.auth_url}/login"
-                driver.get(login_url)
-                
-                # Wait for page load
-                time.sleep(5)
-                
-                # Wait for and fill username
-                wait = WebDriverWait(driver, 20)
-                username_field = wait.until(EC.presence_of_element_located((By.ID, "signInName")))
-                username_field.clear()
-                username_field.send_keys(username)
-                
-                # Wait for and fill password
-                password_field = wait.until(EC.presence_of_element_located((By.ID, "password")))
-                password_field.clear()
-                password_field.send_keys(password)
-                
-                # Submit form
-                submitted = False
-                
-                # Try different submit methods
-                try:
-                    # Look for submit button
-                    submit_button = driver.find_element(By.XPATH, "//button[contains(text(), 'Sign in')] | //button[contains(text(), 'Log in')] | //button[contains(text(), 'Submit')] | //input[@type='submit'] | //button[@type='submit']")
-                    submit_button.click()
-                    submitted = True
-                except:
-                    # Fallback: Press Enter in password field
-                    password_field.send_keys(Keys.RETURN)
-                    submitted = True
-                
-                if not submitted:
-                    return {"success": False, "error": "Could not submit login form"}
-                
-                # Wait for login completion - try multiple approaches
-                try:
-                    # First, wait for redirect away from login page
-                    wait.until(lambda driver: "login.nationalgrid.com" not in driver.current_url)
-                    time.sleep(3)
-                    
-                    # If we're on an OAuth page, we may need to wait for automatic redirect
-                    if "oauth2" in driver.current_url or "b2c_" in driver.current_url:
-                        # Wait up to 30 seconds for OAuth completion
-                        WebDriverWait(driver, 30).until(
-                            lambda driver: "myaccount.nationalgrid.com" in driver.current_url
-                        )
-                    
-                    # Ensure we're actually on the main account page
-                    if "myaccount.nationalgrid.com" not in driver.current_url:
-                        return {"success": False, "error": f"Login didn't redirect to account page. Current URL: {driver.current_url}"}
-                        
-                except Exception as e:
-                    return {"success": False, "error": f"Login timeout or redirect failed: {str(e)}. Current URL: {driver.current_url}"}
-                
-                # Navigate to energy page to trigger opower authentication
-                driver.get(f"{self.auth_url}/Energy")
-                time.sleep(10)  # Give more time for the Energy page to load and set up authentication
-                
-                # Extract tokens from browser storage
-                local_storage = driver.execute_script("return window.localStorage;")
-                session_storage = driver.execute_script("return window.sessionStorage;")
-                
-                # Combine storage data
-                msal_data = {}
-                for key, value in local_storage.items():
-                    msal_data[key] = value
-                for key, value in session_storage.items():
-                    msal_data[f'session_{key}'] = value
-                
-                # Extract access token from storage data
-                access_token = None
-                
-                # Look for access token in various formats
-                for key, value in msal_data.items():
-                    if not value:
-                        continue
-                        
-                    # Check for sessionStorage access tokens with long prefixes
-                    if 'session_' in key and 'accesstoken' in key.lower():
-                        try:
-                            token_data = json.loads(value)
-                            access_token = token_data.get('secret')
-                            if access_token:
-                                break
-                        except:
-                            continue
-                    
-                    # Check for MSAL access tokens
-                    if 'accesstoken' in key.lower() and ('opower' in key.lower() or 'nationalgrid' in key.lower()):
-                        try:
-                            token_data = json.loads(value)
-                            access_token = token_data.get('secret')
-                            if access_token:
-                                break
-                        except:
-                            continue
-                    
-                    # Check for direct token values
-                    if 'access_token' in key.lower():
-                        try:
-                            if value.startswith('{'):
-                                token_data = json.loads(value)
-                                access_token = token_data.get('access_token') or token_data.get('secret')
-                            else:
-                                access_token = value
-                            if access_token:
-                                break
-                        except:
-                            continue
-                    
-                    # Check for Bearer tokens in any value
-                    if isinstance(value, str) and value.startswith('ey') and len(value) > 100:
-                        access_token = value
-                        break
-                
-                if not access_token:
-                    # Debug output to see ALL storage keys and values
-                    debug_info = {
-                        "localStorage_keys": list(local_storage.keys()),
-                        "sessionStorage_keys": list(session_storage.keys()),
-                        "localStorage_sample": {},
-                        "sessionStorage_sample": {},
-                        "current_url": driver.current_url
-                    }
-                    
-                    # Sample localStorage values (first 200 chars)
-                    for key, value in local_storage.items():
-                        if value:
-                            debug_info["localStorage_sample"][key] = str(value)[:200] + "..." if len(str(value)) > 200 else str(value)
-                    
-                    # Sample sessionStorage values (first 200 chars)  
-                    for key, value in session_storage.items():
-                        if value:
-                            debug_info["sessionStorage_sample"][key] = str(value)[:200] + "..." if len(str(value)) > 200 else str(value)
-                    
-                    return {"success": False, "error": "Failed to extract access token", "debug": debug_info}
-                
-                self.tokens = {"access_token": access_token}
-                
-                # Save tokens to cache
-                self.save_tokens(self.tokens)
-                
-                return {"success": True, "source": "fresh_login"}
-                
+                return await self._browser_login(driver, username, password)
             finally:
                 driver.quit()
                 
         except Exception as e:
             return {"success": False, "error": str(e)}
 
+    async def _browser_login(self, driver, username: str, password: str):
+        """Fill the sign-in form in driver and read the access token from browser storage."""
+        # Navigate to login page
+        with span("browser.page_load"):
+            login_url = f"{self.auth_url}/login"
+            driver.get(login_url)
+            
+            # Wait for page load
+            time.sleep(5)
+        
+        with span("browser.fill_form"):
+            # Wait for and fill username
+            wait = WebDriverWait(driver, 20)
+            username_field = wait.until(EC.presence_of_element_located((By.ID, "signInName")))
+            username_field.clear()
+            username_field.send_keys(username)
+            
+            # Wait for and fill password
+            password_field = wait.until(EC.presence_of_element_located((By.ID, "password")))
+            password_field.clear()
+            password_field.send_keys(password)
+            
+            # Submit form
+            submitted = False
+            
+            # Try different submit methods
+            try:
+                # Look for submit button
+                submit_button = driver.find_element(By.XPATH, "//button[contains(text(), 'Sign in')] | //button[contains(text(), 'Log in')] | //button[contains(text(), 'Submit')] | //input[@type='submit'] | //button[@type='submit']")
+                submit_button.click()
+                submitted = True
+            except:
+                # Fallback: Press Enter in password field
+                password_field.send_keys(Keys.RETURN)
+                submitted = True
+        
+        if not submitted:
+            return {"success": False, "error": "Could not submit login form"}
+        
+        # Wait for login completion - try multiple approaches
+        try:
+            with span("browser.redirect_wait"):
+                # First, wait for redirect away from login page
+                wait.until(lambda driver: "login.nationalgrid.com" not in driver.current_url)
+                time.sleep(3)
+                
+                # If we're on an OAuth page, we may need to wait for automatic redirect
+                if "oauth2" in driver.current_url or "b2c_" in driver.current_url:
+                    # Wait up to 30 seconds for OAuth completion
+                    WebDriverWait(driver, 30).until(
+                        lambda driver: "myaccount.nationalgrid.com" in driver.current_url
+                    )
+            
+            # Ensure we're actually on the main account page
+            if "myaccount.nationalgrid.com" not in driver.current_url:
+                return {"success": False, "error": f"Login didn't redirect to account page. Current URL: {driver.current_url}"}
+        
+        except Exception as e:
+            return {"success": False, "error": f"Login timeout or redirect failed: {str(e)}. Current URL: {driver.current_url}"}
+        
+        # Navigate to energy page to trigger opower authentication
+        with span("browser.energy_page"):
+            driver.get(f"{self.auth_url}/Energy")
+            time.sleep(10)  # Give more time for the Energy page to load and set up authentication
+        
+        # Find the access token inside the page so only the token crosses the WebDriver wire
+        with span("browser.storage_read"):
+            token_info = driver.execute_script(TOKEN_EXTRACTION_SCRIPT) or {}
+        access_token = token_info.get('secret')
+        
+        if not access_token:
+            debug_info = {
+                "localStorage_count": token_info.get('localCount'),
+                "sessionStorage_count": token_info.get('sessionCount'),
+                "current_url": driver.current_url
+            }
+            # The full storage dump is only pulled into the process when explicitly asked for
+            if os.getenv('NGNYC_DEBUG_STORAGE', '0').lower() in ('1', 'true', 'yes'):
+                debug_info.update(self.dump_storage(driver))
+            
+            return {"success": False, "error": "Failed to extract access token", "debug": debug_info}
+        
+        msal_entry = {"target": token_info.get('target')}
+        
+        self.tokens = {"access_token": access_token}
+        try:
+            # MSAL stores expiresOn as epoch seconds, usually as a string; anything else is left out
+            self.tokens["expires_on"] = int(token_info['expiresOn'])
+        except (KeyError, TypeError, ValueError):
+            pass
+        
+        # Remember the B2C settings so the next login can skip the browser
+        discovered = discover_login_config(access_token, msal_entry)
+        if discovered:
+            self.login_config = {**self.load_login_config(), **discovered}
+        
+        # Save tokens to cache
+        self.save_tokens(self.tokens)
+        
+        return {"success": True, "source": "fresh_login"}
+
+    def dump_storage(self, driver):
+        """Debug dump of every storage key with truncated values (NGNYC_DEBUG_STORAGE only)."""
+        local_storage = driver.execute_script("return window.localStorage;")
+        session_storage = driver.execute_script("return window.sessionStorage;")
+        
+        # Debug output to see ALL storage keys and values
+        debug_info = {
+            "localStorage_keys": list(local_storage.keys()),
+            "sessionStorage_keys": list(session_storage.keys()),
+            "localStorage_sample": {},
+            "sessionStorage_sample": {}
+        }
+        
+        # Sample localStorage values (first 200 chars)
+        for key, value in local_storage.items():
+            if value:
+                debug_info["localStorage_sample"][key] = str(value)[:200] + "..." if len(str(value)) > 200 else str(value)
+        
+        # Sample sessionStorage values (first 200 chars)  
+        for key, value in session_storage.items():
+            if value:
+                debug_info["sessionStorage_sample"][key] = str(value)[:200] + "..." if len(str(value)) > 200 else str(value)
+        
+        return debug_info
+
     async def get_customer_data(self):
         """Get customer information including URN."""
         try:
@@ -310,43 +498,82 @@ class NationalGridMetroClient:
                 'Accept': 'application/json'
             }
             
-            async with aiohttp.ClientSession() as session:
-                async with session.get(
-                    f"{self.base_url}/ei/edge/apis/multi-account-v1/cws/ngbk/customers/current",
-                    headers=headers
-                ) as resp:
-                    if resp.status == 200:
-                        data = await resp.json()
-                        # Handle the actual response format - it's a single customer object
-                        if isinstance(data, dict) and 'uuid' in data:
-                            # Extract customer URN from uuid
-                            self.customer_urn = f"urn:opower:customer:uuid:{data['uuid']}"
-                            
-                            # Update cache with customer URN
-                            if self.tokens:
-                                self.save_tokens(self.tokens)
-                            
-                            return {"success": True, "customer": data}
-                        # Fallback: check if it's in a results array
-                        elif isinstance(data, dict) and 'results' in data and len(data['results']) > 0:
-                            customer = data['results'][0]
-                            self.customer_urn = customer.get('urn') or f"urn:opower:customer:uuid:{customer.get('uuid')}"
-                            
-                            # Update cache with customer URN
-                            if self.tokens:
-                                self.save_tokens(self.tokens)
-                            
-                            return {"success": True, "customer": customer}
-                        else:
-                            return {"success": False, "error": "Unexpected customer data format", "data": data}
+            status, body = await self._request(
+                "GET",
+                f"{self.base_url}/ei/edge/apis/multi-account-v1/cws/ngbk/customers/current",
+                headers
+            )
+            if status == 200:
+                data = json.loads(body)
+                # Handle the actual response format - it's a single customer object
+                if isinstance(data, dict) and 'uuid' in data:
+                    # Extract customer URN from uuid
+                    self.customer_urn = f"urn:opower:customer:uuid:{data['uuid']}"
+                    
+                    # Update cache with customer URN
+                    if self.tokens:
+                        self.save_tokens(self.tokens)
                     
-                    return {"success": False, "error": f"HTTP {resp.status}", "details": await resp.text()}
+                    return {"success": True, "customer": data}
+                # Fallback: check if it's in a results array
+                elif isinstance(data, dict) and 'results' in data and len(data['results']) > 0:
+                    customer = data['results'][0]
+                    self.customer_urn = customer.get('urn') or f"urn:opower:customer:uuid:{customer.get('uuid')}"
+                    
+                    # Update cache with customer URN
+                    if self.tokens:
+                        self.save_tokens(self.tokens)
+                    
+                    return {"success": True, "customer": customer}
+                else:
+                    return {"success": False, "error": "Unexpected customer data format", "data": data}
+            
+            return {"success": False, "error": f"HTTP {status}", "details": body}
                     
+        except CircuitOpenError as e:
+            return {"success": False, "error": str(e), "circuit_open": True}
         except Exception as e:
             return {"success": False, "error": str(e)}
 
-    async def get_usage_and_cost_data(self):
-        """Get energy usage and cost data using GraphQL."""
+    @staticmethod
+    def resolve_profile(profile=None, fields=None):
+        """Validate fields and pick the query profile; returns (profile, fields) or raises ValueError."""
+        fields = parse_fields(fields)
+        profile = profile or select_profile(fields)
+        if profile not in QUERY_PROFILES:
+            raise ValueError(f"Unknown query profile '{profile}'. Expected one of: {', '.join(QUERY_PROFILES)}")
+        missing = [field for field in fields if field not in QUERY_PROFILES[profile]]
+        if missing:
+            raise ValueError(f"Query profile '{profile}' does not provide field(s): {', '.join(missing)}")
+        return profile, fields
+
+    async def get_usage_and_cost_data(self, profile=None, fields=None):
+        """Get energy usage and cost data using GraphQL.
+        
+        profile picks the query (see queries.py); when omitted, the smallest
+        profile covering the requested extra fields is used.
+        """
+        try:
+            profile, fields = self.resolve_profile(profile, fields)
+        except ValueError as e:
+            return {"success": False, "error": str(e)}
+        
+        with span("graphql.bills", profile=profile):
+            bills_result = await self.fetch_bills(profile)
+        if not bills_result["success"]:
+            return bills_result
+        
+        data = bills_result["response"]
+        with span("process_usage_data"):
+            result = self.process_usage_data(data, fields)
+        if result["success"]:
+            result["query_profile"] = profile
+            with span("history.record"):
+                self.record_history(data)
+        return result
+
+    async def fetch_bills(self, profile=DEFAULT_PROFILE):
+        """Run the bill query for a profile and return the raw GraphQL response."""
         if not self.customer_urn:
             return {"success": False, "error": "Customer URN not available"}
         
@@ -357,7 +584,7 @@ class NationalGridMetroClient:
             # Format like HAR file: "2019-08-05T00:00:00-04:00/2025-07-17T22:02:26-04:00"
             time_interval = f"{start_date.strftime('%Y-%m-%dT00:00:00-04:00')}/{end_date.strftime('%Y-%m-%dT23:59:59-04:00')}"
             
-            # Use the exact working GraphQL query from the HAR file
+            # Query text for the selected profile; "full" is the exact working query from the HAR file
             graphql_query = {
                 "operationName": "WDB_GetCostUsageReadsForBills",
                 "variables": {
@@ -369,84 +596,7 @@ class NationalGridMetroClient:
                     "customerURN": self.customer_urn,
                     "locale": "en-US"
                 },
-                "query": """
-                query WDB_GetCostUsageReadsForBills($customerURN: ID, $last: Int, $timeInterval: TimeInterval, $forceLegacyData: Boolean, $aliased: Boolean) {
-                  billingAccountByAuthContext(
-                    singlePremise: $customerURN
-                    forceLegacyData: $forceLegacyData
-                  ) {
-                    urn
-                    bills(
-                      last: $last
-                      during: $timeInterval
-                      orderBy: ASCENDING
-                      preserveDuplicateSegments: true
-                    ) {
-                      urn
-                      timeInterval
-                      segments {
-                        urn
-                        usageInterval
-                        serviceAgreement(aliased: $aliased) {
-                          urn
-                          uuid
-                          serviceType
-                          __typename
-                        }
-                        estimated
-                        serviceQuantities {
-                          unit
-                          serviceQuantityIdentifier
-                          serviceQuantity {
-                            value
-                            __typename
-                          }
-                          __typename
-                        }
-                        usageCharges {
-                          value
-                          __typename
-                        }
-                        currentAmount {
-                          value
-                          __typename
-                        }
-                        deferredNEMCharges {
-                          value
-                          __typename
-                        }
-                        totalNEMCharges {
-                          value
-                          __typename
-                        }
-                        energyPurchased {
-                          value
-                          __typename
-                        }
-                        energySold {
-                          value
-                          __typename
-                        }
-                        rolloverBalanceEarned {
-                          value
-                          __typename
-                        }
-                        rolloverBalanceUsed {
-                          value
-                          __typename
-                        }
-                        totalEnergyCosts {
-                          value
-                          __typename
-                        }
-                        __typename
-                      }
-                      __typename
-                    }
-                    __typename
-                  }
-                }
-                """
+                "query": BILLS_QUERIES[profile]
             }
             
             headers = {
@@ -456,18 +606,21 @@ class NationalGridMetroClient:
                 'Accept': 'application/json'
             }
             
-            async with aiohttp.ClientSession() as session:
-                async with session.post(
-                    f"{self.base_url}/ei/edge/apis/dsm-graphql-v1/cws/graphql",
-                    headers=headers,
-                    json=graphql_query
-                ) as resp:
-                    if resp.status == 200:
-                        data = await resp.json()
-                        return self.process_usage_data(data)
-                    else:
-                        return {"success": False, "error": f"HTTP {resp.status}", "details": await resp.text()}
+            status, body = await self._request(
+                "POST",
+                f"{self.base_url}/ei/edge/apis/dsm-graphql-v1/cws/graphql",
+                headers,
+                graphql_query
+            )
+            if status == 200:
+                response = json.loads(body)
+                self.health.record_data()
+                return {"success": True, "response": response}
+            else:
+                return {"success": False, "error": f"HTTP {status}", "details": body}
                         
+        except CircuitOpenError as e:
+            return {"success": False, "error": str(e), "circuit_open": True}
         except Exception as e:
             return {"success": False, "error": str(e)}
 
@@ -626,31 +779,30 @@ class NationalGridMetroClient:
             
             results = {}
             
-            async with aiohttp.ClientSession() as session:
-                for query_info in queries_to_try:
-                    try:
-                        async with session.post(
-                            f"{self.base_url}/ei/edge/apis/dsm-graphql-v1/cws/graphql",
-                            headers=headers,
-                            json=query_info["query"]
-                        ) as resp:
-                            if resp.status == 200:
-                                data = await resp.json()
-                                results[query_info["name"]] = {
-                                    "success": True,
-                                    "data": data
-                                }
-                            else:
-                                results[query_info["name"]] = {
-                                    "success": False,
-                                    "error": f"HTTP {resp.status}",
-                                    "details": await resp.text()
-                                }
-                    except Exception as e:
+            for query_info in queries_to_try:
+                try:
+                    status, body = await self._request(
+                        "POST",
+                        f"{self.base_url}/ei/edge/apis/dsm-graphql-v1/cws/graphql",
+                        headers,
+                        query_info["query"]
+                    )
+                    if status == 200:
+                        results[query_info["name"]] = {
+                            "success": True,
+                            "data": json.loads(body)
+                        }
+                    else:
                         results[query_info["name"]] = {
                             "success": False,
-                            "error": str(e)
+                            "error": f"HTTP {status}",
+                            "details": body
                         }
+                except Exception as e:
+                    results[query_info["name"]] = {
+                        "success": False,
+                        "error": str(e)
+                    }
             
             return {
                 "success": True,
@@ -661,7 +813,139 @@ class NationalGridMetroClient:
         except Exception as e:
             return {"success": False, "error": str(e)}
 
-    def process_usage_data(self, graphql_response):
+    def summarize_segment(self, segment):
+        """Sum the usage and charges of a single bill segment."""
+        usage_amount = 0
+        usage_unit = None
+        
+        # Get service quantities (usage data)
+        service_quantities = segment.get('serviceQuantities', [])
+        for sq in service_quantities:
+            unit = sq.get('unit', '')
+            service_quantity = sq.get('serviceQuantity', {})
+            value = service_quantity.get('value', 0)
+            identifier = sq.get('serviceQuantityIdentifier', '')
+            
+            # Match various unit formats for therms
+            if unit and (unit.upper() == 'TH' or 'therm' in unit.lower()):
+                usage_amount += value if value else 0
+                usage_unit = 'therms'  # Standardize to 'therms'
+            elif identifier and ('NET_USAGE' in identifier or 'therm' in identifier.lower()):
+                usage_amount += value if value else 0
+                usage_unit = 'therms'
+            elif unit and ('gas' in unit.lower() or 'cubic' in unit.lower()):
+                usage_amount += value if value else 0
+                usage_unit = unit
+        
+        # Get usage charges (cost data)
+        usage_charges = None
+        charges = segment.get('usageCharges', {})
+        if charges and 'value' in charges:
+            usage_charges = charges.get('value', 0)
+        
+        # Also check currentAmount for cost
+        current_amount = None
+        amount = segment.get('currentAmount', {})
+        if amount and 'value' in amount:
+            current_amount = amount.get('value', 0)
+        
+        return {
+            "usage_amount": usage_amount,
+            "usage_unit": usage_unit,
+            "usage_charges": usage_charges,
+            "current_amount": current_amount,
+            "cost_amount": (usage_charges or 0) + (current_amount or 0)
+        }
+
+    def record_history(self, graphql_response, periods=None):
+        """Upsert the bills and segments of a GraphQL response into the history store."""
+        try:
+            billing_account = graphql_response.get('data', {}).get('billingAccountByAuthContext', {})
+            bills = billing_account.get('bills', [])
+            if periods is None:
+                periods = self.build_periods(graphql_response)
+            bill_rows = [period.to_bill_row() for period in periods]
+            segment_rows = []
+            
+            for bill, period in zip(bills, periods):
+                for segment in bill.get('segments', []):
+                    summary = self.summarize_segment(segment)
+                    segment_start, segment_end = split_interval(segment.get('usageInterval', ''))
+                    estimated = segment.get('estimated')
+                    segment_rows.append({
+                        "urn": segment.get('urn'),
+                        "bill_urn": bill.get('urn'),
+                        "start_date": segment_start,
+                        "end_date": segment_end,
+                        "service_type": (segment.get('serviceAgreement') or {}).get('serviceType'),
+                        "estimated": None if estimated is None else int(bool(estimated)),
+                        "usage_amount": summary["usage_amount"],
+                        "usage_unit": summary["usage_unit"] or period.usage_unit,
+                        "usage_charges": summary["usage_charges"],
+                        "current_amount": summary["current_amount"]
+                    })
+            
+            self.history.record(bill_rows, segment_rows)
+            return True
+        except Exception as e:
+            print(f"Warning: Could not record history: {e}", file=sys.stderr)
+            return False
+
+    def summarize_extra_fields(self, segments, fields):
+        """Aggregate the optional ?fields= values of a bill's segments."""
+        extras = {}
+        for field in fields:
+            for output_key, segment_key in FIELD_OUTPUT_KEYS.get(field, {}).items():
+                if field == "estimated":
+                    extras[output_key] = any(segment.get(segment_key) for segment in segments)
+                elif field == "service_type":
+                    extras[output_key] = sorted({
+                        (segment.get(segment_key) or {}).get('serviceType')
+                        for segment in segments
+                        if (segment.get(segment_key) or {}).get('serviceType')
+                    })
+                else:
+                    values = [
+                        (segment.get(segment_key) or {}).get('value')
+                        for segment in segments
+                    ]
+                    values = [value for value in values if value is not None]
+                    extras[output_key] = sum(values) if values else None
+        return extras
+
+    def extra_output_keys(self, fields):
+        """Output keys added to each period for the requested ?fields=, in request order."""
+        return [key for field in fields or [] for key in FIELD_OUTPUT_KEYS.get(field, {})]
+    
+    def build_periods(self, graphql_response, fields=None):
+        """Turn the bills of a GraphQL response into compact UsagePeriod records."""
+        billing_account = graphql_response.get('data', {}).get('billingAccountByAuthContext', {})
+        periods = []
+        
+        for bill in billing_account.get('bills', []):
+            segments = bill.get('segments', [])
+            
+            # Process segments to get usage and cost data
+            bill_usage = 0
+            bill_cost = 0
+            usage_unit = "therms"
+            
+            for segment in segments:
+                segment_summary = self.summarize_segment(segment)
+                bill_usage += segment_summary["usage_amount"]
+                if segment_summary["usage_unit"]:
+                    usage_unit = segment_summary["usage_unit"]
+                bill_cost += segment_summary["cost_amount"]
+            
+            extras = self.summarize_extra_fields(segments, fields) if fields else None
+            # timeInterval format: "2024-06-01T00:00:00-04:00/2024-06-28T23:59:59-04:00"
+            periods.append(UsagePeriod.from_interval(
+                bill.get('urn'), bill.get('timeInterval', ''), bill_usage, usage_unit, bill_cost, "USD", extras
+            ))
+        
+        return periods
+    
+    def process_usage_data(self, graphql_response, fields=None):
         """Process GraphQL response into structured usage and cost data."""
         try:
             billing_account = graphql_response.get('data', {}).get('billingAccountByAuthContext', {})
@@ -680,91 +964,36 @@ class NationalGridMetroClient:
                     }
                 }
             
-            # Process bills with the actual HAR file structure
-            usage_over_time = []
-            cost_over_time = []
-            total_usage = 0
-            total_cost = 0
+            return self.summarize_periods(self.build_periods(graphql_response, fields), fields)
+        
+        except Exception as e:
+            return {"success": False, "error": f"Failed to process usage data: {str(e)}"}
+    
+    def summarize_periods(self, periods, fields=None):
+        """Serialize UsagePeriod records into the public usage and cost response."""
+        try:
+            if not periods:
+                return {"success": False, "error": "No bills data found"}
+            
+            # Periods are converted to their public dict shape only here; both lists share the dicts
+            extra_keys = self.extra_output_keys(fields)
+            usage_over_time = [period.to_dict(extra_keys) for period in periods]
+            cost_over_time = list(usage_over_time)
+            total_usage = sum(period.usage_amount for period in periods)
+            total_cost = sum(period.cost_amount for period in periods)
+            usage_unit = periods[-1].usage_unit
+            cost_unit = periods[-1].cost_unit
             current_month_estimate = None
             now = datetime.now()
             
-            # Process each bill
-            for bill in bills:
-                time_interval = bill.get('timeInterval', '')
-                segments = bill.get('segments', [])
-                
-                # Extract time info from timeInterval (format: "2024-06-01T00:00:00-04:00/2024-06-28T23:59:59-04:00")
-                start_date = None
-                end_date = None
-                if '/' in time_interval:
-                    start_date, end_date = time_interval.split('/')
-                
-                # Process segments to get usage and cost data
-                bill_usage = 0
-                bill_cost = 0
-                usage_unit = "therms"
-                cost_unit = "USD"
-                
-                for segment in segments:
-                    # Get service quantities (usage data)
-                    service_quantities = segment.get('serviceQuantities', [])
-                    for sq in service_quantities:
-                        unit = sq.get('unit', '')
-                        service_quantity = sq.get('serviceQuantity', {})
-                        value = service_quantity.get('value', 0)
-                        identifier = sq.get('serviceQuantityIdentifier', '')
-                        
-                        # Match various unit formats for therms
-                        if unit and (unit.upper() == 'TH' or 'therm' in unit.lower()):
-                            bill_usage += value if value else 0
-                            usage_unit = 'therms'  # Standardize to 'therms'
-                        elif identifier and ('NET_USAGE' in identifier or 'therm' in identifier.lower()):
-                            bill_usage += value if value else 0
-                            usage_unit = 'therms'
-                        elif unit and ('gas' in unit.lower() or 'cubic' in unit.lower()):
-                            bill_usage += value if value else 0
-                            usage_unit = unit
-                    
-                    # Get usage charges (cost data)
-                    usage_charges = segment.get('usageCharges', {})
-                    if usage_charges and 'value' in usage_charges:
-                        bill_cost += usage_charges.get('value', 0)
-                    
-                    # Also check currentAmount for cost
-                    current_amount = segment.get('currentAmount', {})
-                    if current_amount and 'value' in current_amount:
-                        bill_cost += current_amount.get('value', 0)
-                
-                period_data = {
-                    "start_date": start_date,
-                    "end_date": end_date,
-                    "usage_amount": bill_usage,
-                    "usage_unit": usage_unit,
-                    "cost_amount": bill_cost,
-                    "cost_unit": cost_unit,
-                    "time_interval": time_interval
-                }
-                
-                usage_over_time.append(period_data)
-                cost_over_time.append(period_data)
-                
-                total_usage += bill_usage
-                total_cost += bill_cost
-            
             # Find current month estimate by checking if we're in an active billing period
             if usage_over_time:
                 # Get the most recent billing period
                 latest_period = usage_over_time[-1]
                 
                 try:
-                    # Parse dates to check if current date falls within the latest billing period
-                    # Handle ISO format with timezone offset (e.g., "2025-05-30T00:00:00-04:00")
-                    start_dt = datetime.fromisoformat(latest_period["start_date"])
-                    end_dt = datetime.fromisoformat(latest_period["end_date"])
-                    
-                    # Remove timezone info for comparison (convert to naive datetime)
-                    start_dt = start_dt.replace(tzinfo=None)
-                    end_dt = end_dt.replace(tzinfo=None)
+                    # Compare the latest billing period's wall-clock dates with now (naive datetimes)
+                    start_dt, end_dt = periods[-1].wall_clock()
                     current_dt = now.replace(tzinfo=None)
                     
                     # Check if current date is within this billing period
@@ -836,7 +1065,7 @@ class NationalGridMetroClient:
                     "summary": {
                         "total_usage": total_usage,
                         "total_cost": total_cost,
-                        "number_of_bills": len(bills),
+                        "number_of_bills": len(periods),
                         "usage_unit": usage_unit,
                         "cost_unit": cost_unit
                     }
@@ -846,16 +1075,111 @@ class NationalGridMetroClient:
         except Exception as e:
             return {"success": False, "error": f"Failed to process usage data: {str(e)}"}
 
+def parse_args(argv):
+    """Parse command line arguments."""
+    parser = argparse.ArgumentParser(
+        description="Retrieve National Grid Metro NYC usage and cost data as JSON."
+    )
+    parser.add_argument("username", nargs="?", help="National Grid account username")
+    parser.add_argument("password", nargs="?", help="National Grid account password")
+    
+    export_group = parser.add_argument_group("export", "Write stored history to a file instead of fetching")
+    export_group.add_argument("--export", choices=["csv", "parquet", "arrow"], help="Export format")
+    export_group.add_argument("--output", help="Export file path (default: <table>.<format>)")
+    export_group.add_argument("--table", choices=["bills", "segments"], default="bills", help="History table to export")
+    export_group.add_argument("--columns", help="Comma-separated list of columns to export")
+    export_group.add_argument("--start", help="Only periods starting on or after this date (YYYY-MM-DD)")
+    export_group.add_argument("--end", help="Only periods starting on or before this date (YYYY-MM-DD)")
+    
+    parser.add_argument("--profile", choices=["minimal", "nem", "full"], help="GraphQL query profile (default: smallest covering --fields)")
+    parser.add_argument("--fields", help="Comma-separated extra per-period fields: estimated, service_type, total_energy_costs, nem")
+    
+    fixture_group = parser.add_argument_group("fixtures", "Record or replay opower.com exchanges")
+    fixture_group.add_argument("--record", metavar="FIXTURE", help="Record scrubbed customer/GraphQL exchanges to this file")
+    fixture_group.add_argument("--replay", metavar="FIXTURE", help="Replay exchanges from this file instead of calling opower.com")
+    fixture_group.add_argument("--replay-latency-ms", type=float, default=0, help="Latency injected into each replayed response")
+    fixture_group.add_argument("--replay-jitter-ms", type=float, default=0, help="Random extra latency up to this many ms")
+    
+    batch_group = parser.add_argument_group("batch", "Collect many accounts from a credentials file")
+    batch_group.add_argument("--batch", metavar="CREDENTIALS", help="JSON lines file of {\"username\", \"password\"} objects")
+    batch_group.add_argument("--batch-output", metavar="PATH", help="JSON lines results file (default: stdout)")
+    batch_group.add_argument("--workers", type=int, default=2, help="Maximum concurrent browser logins (default: 2)")
+    batch_group.add_argument("--concurrency", type=int, default=8, help="Maximum accounts fetched at once (default: 8)")
+    
+    return parser.parse_args(argv)
+
+def run_export(client, args):
+    """Export stored history according to the --export options."""
+    try:
+        from .export import export_history
+    except ImportError:
+        from export import export_history
+    
+    output = args.output or f"{args.table}.{args.export}"
+    columns = [column.strip() for column in args.columns.split(',')] if args.columns else None
+    
+    try:
+        rows = export_history(client.history, args.export, output, args.table, columns, args.start, args.end)
+    except ValueError as e:
+        return {"success": False, "error": str(e)}
+    finally:
+        client.history.close()
+    
+    return {"success": True, "output": output, "format": args.export, "table": args.table, "rows": rows}
+
 async def main():
     """Main function - entry point for the script."""
-    if len(sys.argv) != 3:
+    args = parse_args(sys.argv[1:])
+    
+    transport = None
+    if args.replay:
+        try:
+            transport = ReplayTransport(args.replay, args.replay_latency_ms, args.replay_jitter_ms)
+        except (OSError, ValueError) as e:
+            print(json.dumps({"success": False, "error": f"Could not load fixture: {e}"}))
+            sys.exit(1)
+    elif args.record:
+        transport = RecordingTransport(args.record)
+    
+    client = NationalGridMetroClient(transport=transport)
+    
+    if args.export:
+        export_result = run_export(client, args)
+        print(json.dumps(export_result))
+        if not export_result["success"]:
+            sys.exit(1)
+        return
+    
+    if args.batch:
+        try:
+            from .batch import run_batch
+        except ImportError:
+            from batch import run_batch
+        
+        try:
+            client_factory = functools.partial(NationalGridMetroClient, transport=transport)
+            batch_result = await run_batch(client_factory, args.batch, args.batch_output,
+                                           max(1, args.workers), max(1, args.concurrency))
+        except (OSError, ValueError) as e:
+            print(json.dumps({"success": False, "error": str(e)}))
+            sys.exit(1)
+        
+        print(f"# Batch completed: {batch_result['succeeded']}/{batch_result['accounts']} accounts succeeded", file=sys.stderr)
+        if not batch_result["success"]:
+            sys.exit(1)
+        return
+    
+    if client.is_offline:
+        # Credentials are not needed to replay fixtures
+        args.username = args.username or "replay"
+        args.password = args.password or "replay"
+    
+    if not args.username or not args.password:
         print(json.dumps({"success": False, "error": "Usage: python3 nationalgridmetro.py username password"}))
         sys.exit(1)
     
-    username = sys.argv[1]
-    password = sys.argv[2]
-    
-    client = NationalGridMetroClient()
+    username = args.username
+    password = args.password
     
     # Step 1: Check for existing valid tokens
     cached_result = client.load_tokens()
@@ -887,7 +1211,7 @@ async def main():
             sys.exit(1)
     
     # Step 3: Get usage and cost data
-    usage_result = await client.get_usage_and_cost_data()
+    usage_result = await client.get_usage_and_cost_data(args.profile, args.fields)
     print(json.dumps(usage_result, indent=2))
 
 if __name__ == "__main__":
@@ -0,0 +1,122 @@
+#!/usr/bin/env python3
+"""
+GraphQL query profiles for the WDB_GetCostUsageReadsForBills bill query.
+Each profile requests only the segment fields it needs; select_profile()
+picks the smallest profile that covers a set of requested output fields.
+"""
+
+# Segment selections per output field, in GraphQL syntax (without __typename)
+FIELD_SELECTIONS = {
+    "usage": ["serviceQuantities { unit serviceQuantityIdentifier serviceQuantity { value } }"],
+    "cost": ["usageCharges { value }", "currentAmount { value }"],
+    "estimated": ["estimated"],
+    "service_type": ["serviceAgreement(aliased: $aliased) { urn uuid serviceType }"],
+    "total_energy_costs": ["totalEnergyCosts { value }"],
+    "nem": [
+        "deferredNEMCharges { value }",
+        "totalNEMCharges { value }",
+        "energyPurchased { value }",
+        "energySold { value }",
+        "rolloverBalanceEarned { value }",
+        "rolloverBalanceUsed { value }",
+    ],
+}
+
+# Profiles from smallest to largest; "full" matches the query captured from the website
+QUERY_PROFILES = {
+    "minimal": ["usage", "cost"],
+    "nem": ["usage", "cost", "nem"],
+    "full": ["service_type", "estimated", "usage", "cost", "nem", "total_energy_costs"],
+}
+
+DEFAULT_PROFILE = "minimal"
+
+# Extra per-period output keys produced by process_usage_data() for each field
+FIELD_OUTPUT_KEYS = {
+    "estimated": {"estimated": "estimated"},
+    "service_type": {"service_types": "serviceAgreement"},
+    "total_energy_costs": {"total_energy_costs": "totalEnergyCosts"},
+    "nem": {
+        "deferred_nem_charges": "deferredNEMCharges",
+        "total_nem_charges": "totalNEMCharges",
+        "energy_purchased": "energyPurchased",
+        "energy_sold": "energySold",
+        "rollover_balance_earned": "rolloverBalanceEarned",
+        "rollover_balance_used": "rolloverBalanceUsed",
+    },
+}
+
+
+def parse_fields(fields):
+    """Parse a comma-separated ?fields= value into a list, validating each name."""
+    if not fields:
+        return []
+    if isinstance(fields, str):
+        fields = [field.strip() for field in fields.split(',') if field.strip()]
+    unknown = [field for field in fields if field not in FIELD_SELECTIONS]
+    if unknown:
+        raise ValueError(f"Unknown field(s): {', '.join(unknown)}. Expected any of: {', '.join(FIELD_SELECTIONS)}")
+    return list(fields)
+
+
+def select_profile(fields=None):
+    """Return the smallest profile whose fields cover every requested field."""
+    requested = set(parse_fields(fields))
+    for name, profile_fields in QUERY_PROFILES.items():
+        if requested.issubset(profile_fields):
+            return name
+    return "full"
+
+
+def build_bills_query(profile=DEFAULT_PROFILE):
+    """Build the bill query text for a profile."""
+    if profile not in QUERY_PROFILES:
+        raise ValueError(f"Unknown query profile '{profile}'. Expected one of: {', '.join(QUERY_PROFILES)}")
+
+    # The full profile keeps __typename on every object, as the website requests it
+    typename = profile == "full"
+    selections = ["urn", "usageInterval"]
+    for field in QUERY_PROFILES[profile]:
+        selections.extend(FIELD_SELECTIONS[field])
+    if typename:
+        selections = [
+            selection.replace(" }", " __typename }") if "{" in selection else selection
+            for selection in selections
+        ]
+        selections.append("__typename")
+
+    # GraphQL rejects declared-but-unused variables, so $aliased only comes with serviceAgreement
+    variables = "$customerURN: ID, $last: Int, $timeInterval: TimeInterval, $forceLegacyData: Boolean"
+    if "service_type" in QUERY_PROFILES[profile]:
+        variables += ", $aliased: Boolean"
+
+    indent = "\n                        "
+    bill_typename = "\n                      __typename" if typename else ""
+    account_typename = "\n                    __typename" if typename else ""
+
+    return f"""
+                query WDB_GetCostUsageReadsForBills({variables}) {{
+                  billingAccountByAuthContext(
+                    singlePremise: $customerURN
+                    forceLegacyData: $forceLegacyData
+                  ) {{
+                    urn
+                    bills(
+                      last: $last
+                      during: $timeInterval
+                      orderBy: ASCENDING
+                      preserveDuplicateSegments: true
+                    ) {{
+                      urn
+                      timeInterval
+                      segments {{
+                        {indent.join(selections)}
+                      }}{bill_typename}
+                    }}{account_typename}
+                  }}
+                }}
+                """
+
+
+# Built once at import; query text never changes at runtime
+BILLS_QUERIES = {profile: build_bills_query(profile) for profile in QUERY_PROFILES}
@@ -0,0 +1,130 @@
+#!/usr/bin/env python3
+"""
+Compact in-memory form of billing periods.
+A UsagePeriod keeps parsed epoch timestamps (plus the UTC offsets needed to
+reproduce the original strings) and interned unit names instead of a dict
+of interval strings. Records are turned into the public JSON shape only
+when a response is serialized.
+"""
+
+import sys
+from dataclasses import dataclass
+from datetime import datetime, timedelta, timezone
+
+
+def intern_unit(unit):
+    """Share one string object per unit name ("therms", "USD", ...) across all records."""
+    return sys.intern(unit) if unit else unit
+
+
+def parse_timestamp(value):
+    """Parse an ISO timestamp into (epoch seconds, UTC offset in minutes); None if it cannot round-trip."""
+    try:
+        parsed = datetime.fromisoformat(value)
+    except (TypeError, ValueError):
+        return None
+    offset = parsed.utcoffset()
+    if offset is None:
+        return None
+    epoch = int(parsed.timestamp())
+    offset_minutes = int(offset.total_seconds() // 60)
+    # Fractional seconds or unusual spellings are kept as the raw string instead
+    if format_timestamp(epoch, offset_minutes) != value:
+        return None
+    return epoch, offset_minutes
+
+
+def format_timestamp(epoch, offset_minutes):
+    """Inverse of parse_timestamp()."""
+    return datetime.fromtimestamp(epoch, timezone(timedelta(minutes=offset_minutes))).isoformat()
+
+
+@dataclass(slots=True)
+class UsagePeriod:
+    urn: str
+    start: int
+    end: int
+    start_offset: int
+    end_offset: int
+    usage_amount: float
+    usage_unit: str
+    cost_amount: float
+    cost_unit: str
+    # Optional ?fields= values, only present when requested
+    extras: dict = None
+    # Original interval string, only kept when it could not be parsed exactly
+    raw_interval: str = None
+
+    @classmethod
+    def from_interval(cls, urn, time_interval, usage_amount, usage_unit, cost_amount, cost_unit, extras=None):
+        start = end = None
+        if time_interval and '/' in time_interval:
+            start_text, end_text = time_interval.split('/', 1)
+            start, end = parse_timestamp(start_text), parse_timestamp(end_text)
+        if start is None or end is None:
+            return cls(urn, None, None, None, None, usage_amount, intern_unit(usage_unit),
+                       cost_amount, intern_unit(cost_unit), extras or None, time_interval)
+        return cls(urn, start[0], end[0], start[1], end[1], usage_amount, intern_unit(usage_unit),
+                   cost_amount, intern_unit(cost_unit), extras or None)
+
+    @property
+    def start_date(self):
+        if self.start is None:
+            return self._raw_half(0)
+        return format_timestamp(self.start, self.start_offset)
+
+    @property
+    def end_date(self):
+        if self.end is None:
+            return self._raw_half(1)
+        return format_timestamp(self.end, self.end_offset)
+
+    @property
+    def time_interval(self):
+        if self.raw_interval is not None:
+            return self.raw_interval
+        return f"{self.start_date}/{self.end_date}"
+
+    def _raw_half(self, index):
+        if self.raw_interval and '/' in self.raw_interval:
+            return self.raw_interval.split('/', 1)[index]
+        return None
+
+    def wall_clock(self):
+        """Start and end as naive local wall-clock datetimes (the timezone offset is dropped, not applied)."""
+        if self.start is None or self.end is None:
+            # Same failure the string-based code hit for malformed intervals
+            return (datetime.fromisoformat(self.start_date).replace(tzinfo=None),
+                    datetime.fromisoformat(self.end_date).replace(tzinfo=None))
+        return (datetime(1970, 1, 1) + timedelta(seconds=self.start + self.start_offset * 60),
+                datetime(1970, 1, 1) + timedelta(seconds=self.end + self.end_offset * 60))
+
+    def to_dict(self, extra_keys=None):
+        """Public period_data shape used in usage_over_time / cost_over_time, plus the given extras."""
+        period_data = {
+            "start_date": self.start_date,
+            "end_date": self.end_date,
+            "usage_amount": self.usage_amount,
+            "usage_unit": self.usage_unit,
+            "cost_amount": self.cost_amount,
+            "cost_unit": self.cost_unit,
+            "time_interval": self.time_interval
+        }
+        if extra_keys and self.extras:
+            for key in extra_keys:
+                if key in self.extras:
+                    period_data[key] = self.extras[key]
+        return period_data
+
+    def to_bill_row(self):
+        """Row for the bills table of the history store."""
+        return {
+            "urn": self.urn,
+            "start_date": self.start_date,
+            "end_date": self.end_date,
+            "usage_amount": self.usage_amount,
+            "usage_unit": self.usage_unit,
+            "cost_amount": self.cost_amount,
+            "cost_unit": self.cost_unit,
+            "time_interval": self.time_interval
+        }
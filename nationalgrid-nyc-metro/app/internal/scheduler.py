@@ -0,0 +1,265 @@
+#!/usr/bin/env python3
+"""
+Adaptive server-side polling that follows the billing cycle.
+Bills only appear around the end of each billing period, so the scheduler
+learns the period length from stored history, polls often only in a window
+around the expected bill date, and rarely otherwise. Clients are served
+from the last polled GraphQL response instead of triggering upstream calls.
+
+Environment variables:
+  NGNYC_POLLING              "on_demand" (default) or "adaptive"
+  NGNYC_POLL_FAST            seconds between polls near the expected bill date (default: 3600)
+  NGNYC_POLL_SLOW            seconds between polls mid-cycle (default: 86400)
+  NGNYC_POLL_OVERDUE         seconds between polls once a bill is late (default: 21600)
+  NGNYC_POLL_WINDOW_BEFORE   days before the expected bill date to start fast polling (default: 2)
+  NGNYC_POLL_WINDOW_AFTER    days after the expected bill date to keep fast polling (default: 5)
+  NGNYC_POLL_FIELDS          extra ?fields= the scheduled poll should cover (default: none)
+"""
+
+import asyncio
+import fcntl
+import os
+import sys
+import threading
+import time
+from datetime import datetime, timedelta
+from statistics import median
+
+try:
+    from .shared_cache import atomic_write_json, read_json
+    from .tracing import RequestTrace
+except ImportError:
+    from shared_cache import atomic_write_json, read_json
+    from tracing import RequestTrace
+
+DEFAULT_PERIOD_DAYS = 30
+
+# Number of most recent bills used to learn the cadence
+CADENCE_SAMPLE = 12
+
+
+def learn_cadence(store):
+    """Return (median period length in days, end of the latest stored bill) from history."""
+    rows = store.connect().execute(
+        "SELECT start_date, end_date FROM bills WHERE start_date IS NOT NULL AND end_date IS NOT NULL "
+        "ORDER BY start_date DESC LIMIT ?",
+        (CADENCE_SAMPLE,)
+    ).fetchall()
+
+    periods = []
+    last_end = None
+    for start_date, end_date in rows:
+        try:
+            start_dt = datetime.fromisoformat(start_date).replace(tzinfo=None)
+            end_dt = datetime.fromisoformat(end_date).replace(tzinfo=None)
+        except ValueError:
+            continue
+        periods.append((end_dt - start_dt).total_seconds() / 86400)
+        last_end = max(last_end, end_dt) if last_end else end_dt
+
+    period_days = median(periods) if periods else DEFAULT_PERIOD_DAYS
+    return period_days, last_end
+
+
+class PollPlan:
+    """Decides when the next upstream poll should happen."""
+
+    def __init__(self, fast=3600, slow=86400, overdue=21600, window_before=2, window_after=5):
+        self.fast = fast
+        self.slow = slow
+        self.overdue = overdue
+        self.window_before = timedelta(days=window_before)
+        self.window_after = timedelta(days=window_after)
+
+    @classmethod
+    def from_env(cls):
+        return cls(
+            fast=int(os.getenv('NGNYC_POLL_FAST', '3600')),
+            slow=int(os.getenv('NGNYC_POLL_SLOW', '86400')),
+            overdue=int(os.getenv('NGNYC_POLL_OVERDUE', '21600')),
+            window_before=float(os.getenv('NGNYC_POLL_WINDOW_BEFORE', '2')),
+            window_after=float(os.getenv('NGNYC_POLL_WINDOW_AFTER', '5'))
+        )
+
+    def next_delay(self, period_days, last_end, now=None):
+        """Seconds until the next poll, and a label for the current phase."""
+        now = now or datetime.now()
+        if last_end is None:
+            return self.fast, "learning"
+
+        # The next bill covers the period after last_end and appears once that period closes
+        expected = last_end + timedelta(days=period_days)
+        window_start = expected - self.window_before
+        window_end = expected + self.window_after
+
+        if now < window_start:
+            # Mid-cycle: poll rarely, but wake up in time for the window
+            return max(self.fast, min(self.slow, (window_start - now).total_seconds())), "idle"
+        if now <= window_end:
+            return self.fast, "bill_window"
+        return self.overdue, "overdue"
+
+    def expected_bill_date(self, period_days, last_end):
+        if last_end is None:
+            return None
+        return last_end + timedelta(days=period_days)
+
+
+class PollingScheduler:
+    """Background poller; one leader per cache directory does the upstream work.
+
+    poll is a coroutine function returning {"success": ..., "response": raw}
+    and store_factory returns the HistoryStore used to learn the cadence.
+    decode(profile, response) turns a polled response into the form kept in
+    memory by snapshot(); by default the raw response is kept. on_schedule,
+    if given, is called with the epoch time of the next poll whenever the
+    leader plans one.
+    """
+
+    SNAPSHOT_FILE = "scheduler-snapshot.json"
+    STATE_FILE = "scheduler-state.json"
+
+    def __init__(self, cache_dir, poll, store_factory, profile, plan=None, profiler=None, decode=None, on_schedule=None):
+        self.cache_dir = cache_dir
+        self.poll = poll
+        self.store_factory = store_factory
+        self.profile = profile
+        self.plan = plan or PollPlan.from_env()
+        self.profiler = profiler
+        self.decode = decode
+        self.on_schedule = on_schedule
+        self.failures = 0
+        self._stop = threading.Event()
+        self._thread = None
+        self._lock_fd = None
+        self._snapshot = None
+        self._snapshot_mtime = None
+
+    @property
+    def snapshot_path(self):
+        return os.path.join(self.cache_dir, self.SNAPSHOT_FILE)
+
+    @property
+    def state_path(self):
+        return os.path.join(self.cache_dir, self.STATE_FILE)
+
+    def start(self):
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._run, name="ngnyc-scheduler", daemon=True)
+            self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+
+    def snapshot(self):
+        """Latest poll as {"profile", "fetched_at", "data"}, shared by all workers.
+
+        The file is re-read and decoded only when it changes, and the raw
+        response is not kept in memory once decoded.
+        """
+        try:
+            mtime = os.path.getmtime(self.snapshot_path)
+        except OSError:
+            return None
+        if mtime != self._snapshot_mtime:
+            raw = read_json(self.snapshot_path)
+            if raw:
+                data = raw['response']
+                if self.decode is not None:
+                    data = self.decode(raw['profile'], data)
+                raw = {"profile": raw['profile'], "fetched_at": raw['fetched_at'], "data": data}
+            self._snapshot = raw
+            self._snapshot_mtime = mtime
+        return self._snapshot
+
+    def state(self):
+        return read_json(self.state_path) or {}
+
+    def _try_become_leader(self):
+        """Take the scheduler lock without blocking; held for the life of the process."""
+        if self._lock_fd is not None:
+            return True
+        fd = os.open(os.path.join(self.cache_dir, "scheduler.lock"), os.O_RDWR | os.O_CREAT, 0o600)
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            os.close(fd)
+            return False
+        self._lock_fd = fd
+        # A new leader picks up the poll its predecessor planned
+        self._notify_schedule(self.state().get('next_poll_at') or time.time())
+        return True
+
+    def _notify_schedule(self, next_poll_at):
+        if self.on_schedule is None:
+            return
+        try:
+            self.on_schedule(next_poll_at)
+        except Exception as e:
+            print(f"Warning: Poll schedule hook failed: {e}", file=sys.stderr)
+
+    def _run(self):
+        while not self._stop.is_set():
+            if not self._try_become_leader():
+                # Another worker polls; check again later in case it goes away
+                self._stop.wait(60)
+                continue
+
+            delay = self._due_in()
+            if delay > 0:
+                self._stop.wait(min(delay, 300))
+                continue
+
+            self._poll_once()
+
+    def _due_in(self):
+        next_poll = self.state().get('next_poll_at')
+        if not next_poll:
+            return 0
+        return next_poll - time.time()
+
+    def _poll_once(self):
+        started = time.time()
+        trace = RequestTrace("scheduler.poll", profiler=self.profiler, profile=self.profile)
+        try:
+            result = asyncio.run(self.poll(self.profile))
+        except Exception as e:
+            result = {"success": False, "error": f"Unexpected error: {str(e)}"}
+        trace.end(error=None if result.get("success") else result.get("error"), success=bool(result.get("success")))
+
+        state = self.state()
+        state.update({"last_poll_at": started, "last_poll_seconds": round(time.time() - started, 3)})
+
+        if result.get("success"):
+            self.failures = 0
+            atomic_write_json(self.snapshot_path, {
+                "profile": self.profile,
+                "fetched_at": started,
+                "response": result["response"]
+            })
+            state.update({"last_success_at": started, "last_error": None})
+        else:
+            self.failures += 1
+            state["last_error"] = result.get("error")
+            print(f"Warning: Scheduled poll failed: {result.get('error')}", file=sys.stderr)
+
+        store = self.store_factory()
+        try:
+            period_days, last_end = learn_cadence(store)
+        finally:
+            store.close()
+        delay, phase = self.plan.next_delay(period_days, last_end)
+        if self.failures:
+            # Back off on repeated failures, but never wait longer than a slow poll
+            delay = min(self.plan.slow, min(delay, self.plan.fast) * (2 ** (self.failures - 1)))
+
+        expected = self.plan.expected_bill_date(period_days, last_end)
+        state.update({
+            "phase": phase,
+            "period_days": period_days,
+            "expected_bill_date": expected.isoformat() if expected else None,
+            "next_poll_at": time.time() + delay,
+            "consecutive_failures": self.failures
+        })
+        atomic_write_json(self.state_path, state)
+        self._notify_schedule(state["next_poll_at"])
@@ -0,0 +1,117 @@
+#!/usr/bin/env python3
+"""
+Cross-process cache and locks for running the API under several workers.
+Everything lives in the token cache directory: JSON files are replaced
+atomically so readers never see a partial write, and flock()-based lock
+files make sure only one worker logs in or refreshes a result at a time.
+"""
+
+import asyncio
+import fcntl
+import hashlib
+import json
+import os
+import tempfile
+import time
+from contextlib import asynccontextmanager
+
+try:
+    from .tracing import span
+except ImportError:
+    from tracing import span
+
+
+class LockTimeout(Exception):
+    """Raised when a cross-process lock cannot be acquired in time."""
+
+
+def atomic_write_json(path, data, mode=0o600):
+    """Write JSON to a temporary file in the same directory, then rename it over path."""
+    directory = os.path.dirname(path)
+    fd, tmp_path = tempfile.mkstemp(dir=directory, prefix='.', suffix='.tmp')
+    try:
+        with os.fdopen(fd, 'w') as f:
+            json.dump(data, f, indent=2)
+            f.flush()
+            os.fsync(f.fileno())
+        os.chmod(tmp_path, mode)
+        os.replace(tmp_path, path)
+    except Exception:
+        try:
+            os.remove(tmp_path)
+        except OSError:
+            pass
+        raise
+
+
+def read_json(path):
+    """Read a JSON file, returning None if it is missing or unreadable."""
+    try:
+        with open(path, 'r') as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+
+@asynccontextmanager
+async def async_file_lock(path, timeout=None, poll_interval=0.1):
+    """Hold an exclusive flock() on path, waiting without blocking the event loop.
+
+    Waits forever unless timeout (seconds) is given.
+    """
+    fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o600)
+    try:
+        deadline = None if timeout is None else time.monotonic() + timeout
+        with span("lock.wait", lock=os.path.basename(path)):
+            while True:
+                try:
+                    fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                    break
+                except BlockingIOError:
+                    if deadline is not None and time.monotonic() >= deadline:
+                        raise LockTimeout(f"Timed out waiting for {os.path.basename(path)}")
+                    await asyncio.sleep(poll_interval)
+        yield
+    finally:
+        os.close(fd)
+
+
+class SharedCache:
+    def __init__(self, cache_dir):
+        self.cache_dir = cache_dir
+        if not os.path.exists(self.cache_dir):
+            os.makedirs(self.cache_dir, mode=0o700, exist_ok=True)
+
+    def _path(self, name):
+        return os.path.join(self.cache_dir, name)
+
+    def _result_path(self, key):
+        digest = hashlib.sha256(key.encode()).hexdigest()[:16]
+        return self._path(f"result-{digest}.json")
+
+    def lock(self, name, timeout=None):
+        """Async cross-process lock named name (e.g. "login")."""
+        return async_file_lock(self._path(f"{name}.lock"), timeout)
+
+    def get_result(self, key, max_age):
+        """Return a cached processed result no older than max_age seconds, or None."""
+        if max_age <= 0:
+            return None
+        entry = read_json(self._result_path(key))
+        if not entry or entry.get('key') != key:
+            return None
+        if time.time() - entry.get('saved_at', 0) > max_age:
+            return None
+        return entry.get('result')
+
+    def put_result(self, key, result):
+        """Store a processed result for every worker to share."""
+        try:
+            atomic_write_json(self._result_path(key), {
+                'key': key,
+                'saved_at': time.time(),
+                'result': result
+            })
+            return True
+        except OSError:
+            return False
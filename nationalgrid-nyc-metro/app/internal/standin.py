@@ -0,0 +1,284 @@
+#!/usr/bin/env python3
+"""
+Local stand-ins for the National Grid services, for offline testing.
+Usage: python3 standin.py idp [--port 8765] [--username user] [--password pass]
+       python3 standin.py opower [--port 8766] [--bills 36 | --fixture fixture.json] [--latency-ms 200]
+       python3 standin.py serve [--port 8765] [--bills 36] [--latency-ms 200]
+       python3 standin.py fixture output.json [--bills 36]
+
+The idp command serves a minimal Azure AD B2C look-alike implementing the
+authorize / SelfAsserted / confirmed / token steps used by httplogin.py.
+Point the client at it with NG_B2C_AUTHORITY=http://127.0.0.1:<port> and
+NG_B2C_TENANT, NG_B2C_POLICY, NG_B2C_CLIENT_ID and NG_B2C_SCOPE set to
+any values.
+
+The opower command serves the customer and GraphQL bill endpoints, either
+from a recorded fixture or from synthetic seasonal bills; point the client
+at it with NGNYC_OPOWER_URL=http://127.0.0.1:<port>. GET /_standin/stats
+counts the requests it has answered. serve runs both on one port, and
+fixture writes synthetic bills as a replay fixture for NGNYC_REPLAY.
+"""
+
+import argparse
+import asyncio
+import base64
+import hashlib
+import json
+import math
+import random
+import secrets
+import time
+from datetime import date, timedelta
+from urllib.parse import urlencode
+
+from aiohttp import web
+
+try:
+    from .fixtures import exchange_key, load_fixture, save_fixture
+except ImportError:
+    from fixtures import exchange_key, load_fixture, save_fixture
+
+CUSTOMER_PATH = "/ei/edge/apis/multi-account-v1/cws/ngbk/customers/current"
+GRAPHQL_PATH = "/ei/edge/apis/dsm-graphql-v1/cws/graphql"
+BILLS_OPERATION = "WDB_GetCostUsageReadsForBills"
+
+SIGN_IN_PAGE = """<!DOCTYPE html>
+<html><head><title>Sign in</title></head>
+<body>
+<script>var SETTINGS = {settings};</script>
+<form id="localAccountForm"><input id="signInName"><input id="password" type="password"></form>
+</body></html>"""
+
+
+def _b64url(data):
+    return base64.urlsafe_b64encode(data).rstrip(b'=').decode()
+
+
+def make_fake_jwt(claims):
+    """Build an unsigned JWT-shaped token carrying the given claims."""
+    header = _b64url(json.dumps({"alg": "none", "typ": "JWT"}).encode())
+    payload = _b64url(json.dumps(claims).encode())
+    return f"{header}.{payload}.{_b64url(b'standin')}"
+
+
+def _utc_offset(day):
+    # Close enough to US Eastern daylight saving time for synthetic data
+    return "-04:00" if 3 < day.month < 11 else "-05:00"
+
+
+def synthetic_bills_response(count=36, seed=0, today=None):
+    """GraphQL bills response with count monthly gas bills, heavier in winter, ending last month."""
+    rng = random.Random(seed)
+    today = today or date.today()
+    first = date(today.year, today.month, 1)
+    months = []
+    for _ in range(count):
+        first = (first - timedelta(days=1)).replace(day=1)
+        months.append(first)
+
+    bills = []
+    for index, start in enumerate(reversed(months)):
+        end = (start + timedelta(days=32)).replace(day=1) - timedelta(days=1)
+        interval = f"{start.isoformat()}T00:00:00{_utc_offset(start)}/{end.isoformat()}T23:59:59{_utc_offset(end)}"
+        # Usage peaks in January; charges follow usage plus a fixed delivery charge
+        therms = round(max(5.0, 60 + 55 * math.cos(2 * math.pi * (start.month - 1) / 12) + rng.gauss(0, 6)), 1)
+        usage_charges = round(therms * rng.uniform(1.35, 1.55), 2)
+        current_amount = round(21.5 + rng.uniform(-1, 1), 2)
+        bills.append({
+            "urn": f"urn:opower:bill:standin:{index}",
+            "timeInterval": interval,
+            "segments": [{
+                "urn": f"urn:opower:billsegment:standin:{index}",
+                "usageInterval": interval,
+                "estimated": rng.random() < 0.1,
+                "serviceAgreement": {"serviceType": "GAS"},
+                "serviceQuantities": [{
+                    "unit": "THERM",
+                    "serviceQuantityIdentifier": "NET_USAGE",
+                    "serviceQuantity": {"value": therms}
+                }],
+                "usageCharges": {"value": usage_charges},
+                "currentAmount": {"value": current_amount},
+                "totalEnergyCosts": {"value": usage_charges},
+                "deferredNEMCharges": None,
+                "totalNEMCharges": None,
+                "energyPurchased": None,
+                "energySold": None,
+                "rolloverBalanceEarned": None,
+                "rolloverBalanceUsed": None
+            }]
+        })
+
+    return {"data": {"billingAccountByAuthContext": {"urn": "urn:opower:billingaccount:standin", "bills": bills}}}
+
+
+def synthetic_exchanges(bills=36, seed=0):
+    """Replay fixture exchanges for the customer and bills calls."""
+    customer = {"uuid": "00000000-0000-4000-8000-000000000000"}
+    return [
+        {"key": exchange_key("GET", CUSTOMER_PATH), "status": 200, "body": json.dumps(customer)},
+        {"key": exchange_key("POST", GRAPHQL_PATH, {"operationName": BILLS_OPERATION}), "status": 200,
+         "body": json.dumps(synthetic_bills_response(bills, seed))},
+    ]
+
+
+def add_opower_routes(app, exchanges, latency_ms=0, jitter_ms=0):
+    """Serve the customer and GraphQL endpoints from fixture exchanges on app."""
+    responses = {exchange['key']: (exchange['status'], exchange['body']) for exchange in exchanges}
+    app['opower_stats'] = {"customer": 0, "graphql": 0, "unauthorized": 0}
+
+    async def respond(request, key, counter):
+        if not request.headers.get('Authorization', '').startswith('Bearer '):
+            app['opower_stats']['unauthorized'] += 1
+            return web.Response(status=401, text="Missing bearer token")
+        app['opower_stats'][counter] += 1
+        delay = latency_ms + (random.uniform(0, jitter_ms) if jitter_ms else 0)
+        if delay:
+            await asyncio.sleep(delay / 1000)
+        if key not in responses:
+            return web.Response(status=404, text=f"No stand-in response for {key}")
+        status, body = responses[key]
+        return web.Response(status=status, text=body, content_type='application/json')
+
+    async def customer(request):
+        return await respond(request, exchange_key("GET", CUSTOMER_PATH), "customer")
+
+    async def graphql(request):
+        payload = await request.json()
+        return await respond(request, exchange_key("POST", GRAPHQL_PATH, payload), "graphql")
+
+    async def stats(request):
+        return web.json_response(app['opower_stats'])
+
+    app.router.add_get(CUSTOMER_PATH, customer)
+    app.router.add_post(GRAPHQL_PATH, graphql)
+    app.router.add_get("/_standin/stats", stats)
+    return app
+
+
+def create_opower_app(exchanges, latency_ms=0, jitter_ms=0):
+    """Build the stand-in opower.com application."""
+    return add_opower_routes(web.Application(), exchanges, latency_ms, jitter_ms)
+
+
+def create_idp_app(username, password, token_lifetime=3600, app=None):
+    """Build the stand-in B2C application; state lives in app['transactions'] and app['codes']."""
+    app = app if app is not None else web.Application()
+    app['transactions'] = {}
+    app['codes'] = {}
+
+    async def authorize(request):
+        params = request.query
+        if params.get('code_challenge_method') != 'S256' or not params.get('code_challenge'):
+            return web.Response(status=400, text="PKCE with S256 is required")
+        tenant, policy = request.match_info['tenant'], request.match_info['policy']
+        trans_id = f"StateProperties={secrets.token_urlsafe(12)}"
+        csrf = secrets.token_urlsafe(16)
+        app['transactions'][trans_id] = {
+            "csrf": csrf,
+            "params": dict(params),
+            "tenant": tenant,
+            "policy": policy,
+            "authenticated": False,
+        }
+        settings = {"csrf": csrf, "transId": trans_id, "api": "CombinedSigninAndSignup",
+                    "hosts": {"tenant": f"/{tenant}", "policy": policy}}
+        return web.Response(text=SIGN_IN_PAGE.format(settings=json.dumps(settings)), content_type='text/html')
+
+    async def self_asserted(request):
+        transaction = app['transactions'].get(request.query.get('tx'))
+        if not transaction or request.headers.get('X-CSRF-TOKEN') != transaction['csrf']:
+            return web.json_response({"status": "400", "message": "Invalid transaction"})
+        form = await request.post()
+        if form.get('signInName') != username or form.get('password') != password:
+            return web.json_response({"status": "400", "message": "Invalid username or password."})
+        transaction['authenticated'] = True
+        return web.json_response({"status": "200"})
+
+    async def confirmed(request):
+        transaction = app['transactions'].pop(request.query.get('tx'), None)
+        if not transaction or not transaction['authenticated'] or request.query.get('csrf_token') != transaction['csrf']:
+            return web.Response(status=400, text="Sign-in was not completed")
+        params = transaction['params']
+        code = secrets.token_urlsafe(24)
+        app['codes'][code] = transaction
+        location = f"{params['redirect_uri']}?{urlencode({'state': params.get('state', ''), 'code': code})}"
+        raise web.HTTPFound(location)
+
+    async def token(request):
+        form = await request.post()
+        transaction = app['codes'].pop(form.get('code'), None)
+        if not transaction or form.get('grant_type') != 'authorization_code':
+            return web.json_response({"error": "invalid_grant"}, status=400)
+        params = transaction['params']
+        challenge = _b64url(hashlib.sha256(form.get('code_verifier', '').encode()).digest())
+        if challenge != params['code_challenge'] or form.get('client_id') != params['client_id']:
+            return web.json_response({"error": "invalid_grant", "error_description": "PKCE verification failed"}, status=400)
+        now = int(time.time())
+        access_token = make_fake_jwt({
+            "iss": f"{request.scheme}://{request.host}/{transaction['tenant']}/v2.0/",
+            "azp": params['client_id'],
+            "tfp": transaction['policy'],
+            "scp": params.get('scope', ''),
+            "iat": now,
+            "exp": now + token_lifetime,
+        })
+        return web.json_response({
+            "access_token": access_token,
+            "token_type": "Bearer",
+            "expires_in": token_lifetime,
+            "scope": params.get('scope', ''),
+        })
+
+    prefix = "/{tenant}/{policy}"
+    app.router.add_get(f"{prefix}/oauth2/v2.0/authorize", authorize)
+    app.router.add_post(f"{prefix}/SelfAsserted", self_asserted)
+    app.router.add_get(f"{prefix}/api/{{api}}/confirmed", confirmed)
+    app.router.add_post(f"{prefix}/oauth2/v2.0/token", token)
+    return app
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Local stand-ins for National Grid services.")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    idp_parser = subparsers.add_parser("idp", help="Serve a stand-in B2C identity provider")
+    opower_parser = subparsers.add_parser("opower", help="Serve stand-in opower.com customer and bill endpoints")
+    serve_parser = subparsers.add_parser("serve", help="Serve the identity provider and opower.com on one port")
+    for sub, port in ((idp_parser, 8765), (opower_parser, 8766), (serve_parser, 8765)):
+        sub.add_argument("--host", default="127.0.0.1")
+        sub.add_argument("--port", type=int, default=port)
+    for sub in (idp_parser, serve_parser):
+        sub.add_argument("--username", default="user@example.com")
+        sub.add_argument("--password", default="password")
+    for sub in (opower_parser, serve_parser):
+        sub.add_argument("--fixture", help="Replay fixture to serve instead of synthetic bills")
+        sub.add_argument("--bills", type=int, default=36, help="Number of synthetic monthly bills")
+        sub.add_argument("--seed", type=int, default=0)
+        sub.add_argument("--latency-ms", type=float, default=0, help="Latency added to every response")
+        sub.add_argument("--jitter-ms", type=float, default=0, help="Random extra latency up to this many ms")
+
+    fixture_parser = subparsers.add_parser("fixture", help="Write synthetic bills as a replay fixture")
+    fixture_parser.add_argument("output")
+    fixture_parser.add_argument("--bills", type=int, default=36)
+    fixture_parser.add_argument("--seed", type=int, default=0)
+
+    args = parser.parse_args()
+    if args.command == "fixture":
+        save_fixture(args.output, synthetic_exchanges(args.bills, args.seed))
+        return
+
+    if args.command in ("opower", "serve"):
+        exchanges = load_fixture(args.fixture) if args.fixture else synthetic_exchanges(args.bills, args.seed)
+
+    if args.command == "idp":
+        app = create_idp_app(args.username, args.password)
+    elif args.command == "opower":
+        app = create_opower_app(exchanges, args.latency_ms, args.jitter_ms)
+    else:
+        app = create_idp_app(args.username, args.password, app=create_opower_app(exchanges, args.latency_ms, args.jitter_ms))
+    web.run_app(app, host=args.host, port=args.port)
+
+
+if __name__ == "__main__":
+    main()
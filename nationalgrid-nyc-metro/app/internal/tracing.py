@@ -0,0 +1,344 @@
+#!/usr/bin/env python3
+"""
+Request tracing and slow-request profiling.
+Each request (or scheduled poll) opens a root span; code below it opens
+child spans with span("name"). Finished traces are written as one JSON log
+line and/or sent to an OpenTelemetry collector over OTLP/HTTP. Requests
+slower than a threshold can additionally keep a cProfile or pyinstrument
+report.
+
+Environment variables:
+  PYTHON_LOG_LEVEL          log level for the app (default: INFO; DEBUG also turns on JSON traces)
+  NGNYC_TRACE               comma separated exporters: off, json, otlp (default: off, json at DEBUG)
+  NGNYC_OTLP_ENDPOINT       OTLP/HTTP traces URL (default: http://127.0.0.1:4318/v1/traces)
+  NGNYC_PROFILE_SLOW_MS     keep a profile of requests slower than this many ms, 0 = off (default: 0)
+  NGNYC_PROFILE_SAMPLE      fraction of requests profiled while the threshold is set (default: 1.0)
+  NGNYC_PROFILER            auto, cprofile or pyinstrument (default: auto, pyinstrument when installed)
+  NGNYC_PROFILE_KEEP        number of profile reports kept on disk (default: 20)
+"""
+
+import contextvars
+import cProfile
+import io
+import json
+import logging
+import os
+import pstats
+import queue
+import random
+import secrets
+import sys
+import threading
+import time
+import urllib.request
+from contextlib import contextmanager
+
+try:
+    import pyinstrument
+except ImportError:
+    pyinstrument = None
+
+DEFAULT_OTLP_ENDPOINT = "http://127.0.0.1:4318/v1/traces"
+SERVICE_NAME = "ngnycmetro"
+
+logger = logging.getLogger("ngnycmetro.trace")
+
+_current_span = contextvars.ContextVar("ngnycmetro_span", default=None)
+
+
+def configure_logging():
+    """Set up logging from PYTHON_LOG_LEVEL (exported by run.sh from the add-on log_level)."""
+    level = os.getenv('PYTHON_LOG_LEVEL', 'INFO').upper()
+    logging.basicConfig(
+        level=getattr(logging, level, logging.INFO),
+        format="%(asctime)s %(levelname)s %(name)s: %(message)s",
+        stream=sys.stderr
+    )
+
+
+def trace_exporters():
+    """Exporters named by NGNYC_TRACE; JSON logs are on by default at DEBUG level."""
+    default = 'json' if os.getenv('PYTHON_LOG_LEVEL', 'INFO').upper() == 'DEBUG' else 'off'
+    names = [name.strip().lower() for name in os.getenv('NGNYC_TRACE', default).split(',')]
+    return [name for name in names if name in ('json', 'otlp')]
+
+
+class Span:
+    __slots__ = ("name", "trace_id", "span_id", "parent_id", "start_ns", "end_ns", "attributes", "error", "finished")
+
+    def __init__(self, name, trace_id, parent_id=None, attributes=None, finished=None):
+        self.name = name
+        self.trace_id = trace_id
+        self.span_id = secrets.token_hex(8)
+        self.parent_id = parent_id
+        self.start_ns = time.time_ns()
+        self.end_ns = None
+        self.attributes = dict(attributes or {})
+        self.error = None
+        # Every span of a trace appends itself to the same list when it ends
+        self.finished = finished if finished is not None else []
+
+    def set(self, **attributes):
+        self.attributes.update(attributes)
+
+    def end(self):
+        if self.end_ns is None:
+            self.end_ns = time.time_ns()
+            self.finished.append(self)
+
+    @property
+    def duration_ms(self):
+        return ((self.end_ns or time.time_ns()) - self.start_ns) / 1e6
+
+    def to_dict(self):
+        return {
+            "name": self.name,
+            "span_id": self.span_id,
+            "parent_id": self.parent_id,
+            "start": self.start_ns / 1e9,
+            "duration_ms": round(self.duration_ms, 3),
+            "attributes": self.attributes,
+            "error": self.error
+        }
+
+
+@contextmanager
+def span(name, **attributes):
+    """Time a stage of the current trace; a no-op outside a trace."""
+    parent = _current_span.get()
+    if parent is None:
+        yield None
+        return
+
+    child = Span(name, parent.trace_id, parent.span_id, attributes, parent.finished)
+    token = _current_span.set(child)
+    try:
+        yield child
+    except BaseException as e:
+        child.error = f"{type(e).__name__}: {e}"
+        raise
+    finally:
+        _current_span.reset(token)
+        child.end()
+
+
+def _otlp_value(value):
+    if isinstance(value, bool):
+        return {"boolValue": value}
+    if isinstance(value, int):
+        return {"intValue": str(value)}
+    if isinstance(value, float):
+        return {"doubleValue": value}
+    return {"stringValue": str(value)}
+
+
+def otlp_payload(spans):
+    """Encode finished spans as an OTLP/HTTP JSON ExportTraceServiceRequest."""
+    encoded = []
+    for item in spans:
+        encoded_span = {
+            "traceId": item.trace_id,
+            "spanId": item.span_id,
+            "name": item.name,
+            "kind": 1,
+            "startTimeUnixNano": str(item.start_ns),
+            "endTimeUnixNano": str(item.end_ns),
+            "attributes": [{"key": key, "value": _otlp_value(value)} for key, value in item.attributes.items()],
+            # 1 = OK, 2 = ERROR
+            "status": {"code": 2, "message": item.error} if item.error else {"code": 1}
+        }
+        if item.parent_id:
+            encoded_span["parentSpanId"] = item.parent_id
+        encoded.append(encoded_span)
+
+    return {
+        "resourceSpans": [{
+            "resource": {"attributes": [{"key": "service.name", "value": {"stringValue": SERVICE_NAME}}]},
+            "scopeSpans": [{"scope": {"name": SERVICE_NAME}, "spans": encoded}]
+        }]
+    }
+
+
+class OTLPExporter:
+    """Posts traces to a collector from a background thread so requests never wait on it."""
+
+    def __init__(self, endpoint=None, max_queue=100):
+        self.endpoint = endpoint or os.getenv('NGNYC_OTLP_ENDPOINT', DEFAULT_OTLP_ENDPOINT)
+        self._queue = queue.Queue(maxsize=max_queue)
+        self._warned = False
+        self._thread = threading.Thread(target=self._run, name="ngnycmetro-otlp", daemon=True)
+        self._thread.start()
+
+    def export(self, spans):
+        try:
+            self._queue.put_nowait(spans)
+        except queue.Full:
+            pass
+
+    def _run(self):
+        while True:
+            spans = self._queue.get()
+            body = json.dumps(otlp_payload(spans)).encode()
+            request = urllib.request.Request(self.endpoint, data=body, headers={"Content-Type": "application/json"})
+            try:
+                urllib.request.urlopen(request, timeout=5).close()
+                self._warned = False
+            except Exception as e:
+                # Warn once per outage rather than once per trace
+                if not self._warned:
+                    print(f"Warning: Could not export traces to {self.endpoint}: {e}", file=sys.stderr)
+                    self._warned = True
+
+
+_otlp_exporter = None
+_otlp_lock = threading.Lock()
+
+
+def export_trace(root, spans, exporters):
+    global _otlp_exporter
+    if 'json' in exporters:
+        logger.info(json.dumps({
+            "trace_id": root.trace_id,
+            "name": root.name,
+            "duration_ms": round(root.duration_ms, 3),
+            "spans": [item.to_dict() for item in sorted(spans, key=lambda item: item.start_ns)]
+        }))
+    if 'otlp' in exporters:
+        with _otlp_lock:
+            if _otlp_exporter is None:
+                _otlp_exporter = OTLPExporter()
+        _otlp_exporter.export(spans)
+
+
+class SlowRequestProfiler:
+    """Profiles sampled requests and keeps the report only when a request is slower than threshold_ms."""
+
+    def __init__(self, output_dir, threshold_ms=0, sample_rate=1.0, engine="auto", keep=20):
+        self.output_dir = output_dir
+        self.threshold_ms = threshold_ms
+        self.sample_rate = sample_rate
+        if engine == "auto":
+            engine = "pyinstrument" if pyinstrument is not None else "cprofile"
+        if engine == "pyinstrument" and pyinstrument is None:
+            print("Warning: pyinstrument is not installed, using cProfile", file=sys.stderr)
+            engine = "cprofile"
+        self.engine = engine
+        self.keep = keep
+        # Python allows one active profiler per process, so concurrent requests are not profiled
+        self._busy = threading.Lock()
+
+    @classmethod
+    def from_env(cls, output_dir):
+        return cls(
+            output_dir,
+            threshold_ms=float(os.getenv('NGNYC_PROFILE_SLOW_MS', '0')),
+            sample_rate=float(os.getenv('NGNYC_PROFILE_SAMPLE', '1.0')),
+            engine=os.getenv('NGNYC_PROFILER', 'auto').lower(),
+            keep=int(os.getenv('NGNYC_PROFILE_KEEP', '20'))
+        )
+
+    @property
+    def enabled(self):
+        return self.threshold_ms > 0
+
+    def start(self):
+        """Start profiling the current request; returns a handle for stop(), or None if not sampled."""
+        if not self.enabled or random.random() >= self.sample_rate:
+            return None
+        if not self._busy.acquire(blocking=False):
+            return None
+        try:
+            if self.engine == "pyinstrument":
+                profiler = pyinstrument.Profiler(async_mode="enabled")
+                profiler.start()
+            else:
+                profiler = cProfile.Profile()
+                profiler.enable()
+        except Exception as e:
+            self._busy.release()
+            print(f"Warning: Could not start profiler: {e}", file=sys.stderr)
+            return None
+        return profiler
+
+    def stop(self, profiler, duration_ms, label):
+        """Stop profiling; write the report if the request was slow and return its path."""
+        if profiler is None:
+            return None
+        try:
+            if self.engine == "pyinstrument":
+                profiler.stop()
+            else:
+                profiler.disable()
+            if duration_ms < self.threshold_ms:
+                return None
+            return self._write_report(profiler, duration_ms, label)
+        finally:
+            self._busy.release()
+
+    def _write_report(self, profiler, duration_ms, label):
+        os.makedirs(self.output_dir, mode=0o700, exist_ok=True)
+        safe_label = ''.join(ch if ch.isalnum() else '_' for ch in label).strip('_')
+        path = os.path.join(self.output_dir, f"{time.strftime('%Y%m%d-%H%M%S')}-{int(duration_ms)}ms-{safe_label}.txt")
+
+        if self.engine == "pyinstrument":
+            report = profiler.output_text(unicode=True, color=False)
+        else:
+            stream = io.StringIO()
+            pstats.Stats(profiler, stream=stream).sort_stats('cumulative').print_stats(40)
+            report = stream.getvalue()
+
+        with open(path, 'w') as f:
+            f.write(f"# {label} took {duration_ms:.0f} ms\n")
+            f.write(report)
+
+        # Only the most recent reports are kept
+        reports = sorted(name for name in os.listdir(self.output_dir) if name.endswith('.txt'))
+        for name in reports[:-self.keep] if self.keep else []:
+            try:
+                os.remove(os.path.join(self.output_dir, name))
+            except OSError:
+                pass
+
+        logger.warning("Slow request %s took %.0f ms; profile written to %s", label, duration_ms, path)
+        return path
+
+
+class RequestTrace:
+    """Root span plus optional profile for one request; call end() (or use it as a context manager)."""
+
+    def __init__(self, name, profiler=None, exporters=None, **attributes):
+        self.exporters = trace_exporters() if exporters is None else exporters
+        self.profiler = profiler
+        self.root = Span(name, secrets.token_hex(16), attributes=attributes)
+        self._token = _current_span.set(self.root)
+        self._profile = profiler.start() if profiler is not None else None
+
+    def end(self, error=None, **attributes):
+        """Finish the trace, export it and keep a profile if it was slow; returns the duration in ms."""
+        if self.root.end_ns is not None:
+            return self.root.duration_ms
+        self.root.set(**attributes)
+        if error is not None:
+            self.root.error = f"{type(error).__name__}: {error}" if isinstance(error, BaseException) else str(error)
+        self.root.end()
+        try:
+            _current_span.reset(self._token)
+        except ValueError:
+            # Ended from a different context than it was started in
+            _current_span.set(None)
+
+        duration_ms = self.root.duration_ms
+        if self.profiler is not None:
+            path = self.profiler.stop(self._profile, duration_ms, self.root.name)
+            if path:
+                self.root.set(profile=path)
+        if self.exporters:
+            export_trace(self.root, list(self.root.finished), self.exporters)
+        return duration_ms
+
+    def __enter__(self):
+        return self.root
+
+    def __exit__(self, exc_type, exc, tb):
+        self.end(error=exc)
+        return False
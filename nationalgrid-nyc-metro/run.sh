@@ -28,11 +28,23 @@ if command -v bashio > /dev/null 2>&1; then
     USERNAME=$(bashio::config 'username')
     PASSWORD=$(bashio::config 'password')
     LOG_LEVEL=$(bashio::config 'log_level' 'info')
+    WORKERS=$(bashio::config 'workers' '1')
+    WARM_BROWSER=$(bashio::config 'warm_browser' 'false')
+    POLLING=$(bashio::config 'polling' 'adaptive')
+    TRACING=$(bashio::config 'tracing' 'auto')
+    OTLP_ENDPOINT=$(bashio::config 'otlp_endpoint' '')
+    PROFILE_SLOW_MS=$(bashio::config 'profile_slow_ms' '0')
 else
     # Running in local test environment
     USERNAME="$USERNAME"
     PASSWORD="$PASSWORD"
     LOG_LEVEL="${LOG_LEVEL:-info}"
+    WORKERS="${WORKERS:-1}"
+    WARM_BROWSER="${WARM_BROWSER:-false}"
+    POLLING="${POLLING:-adaptive}"
+    TRACING="${TRACING:-auto}"
+    OTLP_ENDPOINT="${OTLP_ENDPOINT:-}"
+    PROFILE_SLOW_MS="${PROFILE_SLOW_MS:-0}"
 fi
 
 # Validate required configuration
@@ -50,6 +62,28 @@ fi
 export NATIONAL_GRID_USERNAME="$USERNAME"
 export NATIONAL_GRID_PASSWORD="$PASSWORD"
 
+# Keep one browser running between logins instead of starting Chromium every time.
+# Every gunicorn worker would keep its own, so it is only used with a single worker.
+if [ "$WARM_BROWSER" = "true" ]; then
+    if [ "$WORKERS" -gt 1 ] 2>/dev/null; then
+        log_info "warm_browser is ignored with more than one worker (it would keep one Chromium per worker)"
+    else
+        export NGNYC_DRIVER_POOL="1"
+    fi
+fi
+
+# Poll upstream in the background around bill dates instead of on every request
+export NGNYC_POLLING="$POLLING"
+
+# Request tracing (auto = JSON trace logs at debug log level only) and slow-request profiling
+if [ "$TRACING" != "auto" ]; then
+    export NGNYC_TRACE="$TRACING"
+fi
+if [ -n "$OTLP_ENDPOINT" ]; then
+    export NGNYC_OTLP_ENDPOINT="$OTLP_ENDPOINT"
+fi
+export NGNYC_PROFILE_SLOW_MS="$PROFILE_SLOW_MS"
+
 # Set up token cache directory with proper permissions
 mkdir -p /data/.ngnycmetro
 chmod 755 /data/.ngnycmetro
@@ -60,6 +94,8 @@ sed -i 's|~/.ngnycmetro|/data/.ngnycmetro|g' /app/internal/nationalgridmetro.py
 log_info "Starting National Grid NYC Metro API..."
 log_info "Username: ${USERNAME}"
 log_info "Log level: ${LOG_LEVEL}"
+log_info "Workers: ${WORKERS}"
+log_info "Polling: ${POLLING}"
 log_info "API will be available on port 50583"
 
 # Set Python logging level based on addon log level
@@ -83,4 +119,9 @@ esac
 
 # Start the Flask application
 cd /app
-exec python3 app.py 
\ No newline at end of file
+if [ "$WORKERS" -gt 1 ] 2>/dev/null; then
+    # Workers share tokens and results through the data directory and take turns logging in
+    exec gunicorn --workers "$WORKERS" --bind 0.0.0.0:50583 --timeout 300 app:app
+else
+    exec python3 app.py
+fi 
\ No newline at end of file
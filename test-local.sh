@@ -183,6 +183,18 @@ cleanup() {
     print_success "Cleanup completed"
 }
 
+# Function to run the offline load test (stand-in upstream, no Docker or credentials needed)
+run_load_test() {
+    print_status "Running load test against the offline stand-ins..."
+    
+    if python3 nationalgrid-nyc-metro/app/internal/loadtest.py "$@"; then
+        print_success "Load test completed"
+    else
+        print_error "Load test failed"
+        exit 1
+    fi
+}
+
 # Function to show usage
 show_usage() {
     echo "Usage: $0 [COMMAND]"
@@ -194,6 +206,7 @@ show_usage() {
     echo "  logs      - Show container logs"
     echo "  stop      - Stop test container"
     echo "  clean     - Remove test container and image"
+    echo "  loadtest  - Compare serving modes offline (extra arguments go to loadtest.py)"
     echo "  help      - Show this help message"
     echo ""
     echo "Environment Variables Required:"
@@ -240,6 +253,10 @@ case "${1:-test}" in
     "clean")
         cleanup
         ;;
+    "loadtest")
+        shift
+        run_load_test "$@"
+        ;;
     "help"|"-h"|"--help")
         show_usage
         ;;